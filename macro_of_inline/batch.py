@@ -0,0 +1,247 @@
+import multiprocessing
+import os
+import resource
+import select
+import sys
+
+import cfg
+import rewrite
+import timing
+import utils
+
+def collect(paths, files_from=None):
+	"""
+	[Path] -> [File]
+
+	Directories are searched for .c files recursively.
+	"""
+	if files_from:
+		with open(files_from) as fp:
+			paths = paths + [line.strip() for line in fp if line.strip()]
+
+	files = []
+	for path in paths:
+		if not os.path.isdir(path):
+			files.append(path)
+			continue
+		for dirpath, dirnames, filenames in os.walk(path):
+			dirnames.sort()
+			for fn in sorted(filenames):
+				if fn.endswith(".c"):
+					files.append(os.path.join(dirpath, fn))
+	return files
+
+def output_of(filename, output_dir):
+	"""
+	Overwrite the input file if output_dir is None
+	"""
+	if not output_dir:
+		return filename
+	path = os.path.abspath(filename)
+	rel = os.path.relpath(path)
+	if rel.startswith(os.pardir):
+		rel = path.lstrip(os.sep)
+	return os.path.join(output_dir, rel)
+
+def run_one(filename, output):
+	rewrite.reset()
+
+	dn = os.path.dirname(output)
+	if dn and not os.path.exists(dn):
+		try:
+			os.makedirs(dn)
+		except OSError: # Other worker may have created
+			pass
+
+	utils.write_file(output, rewrite.Main(filename).emit)
+
+def rss():
+	"""
+	Current resident set size in bytes
+	"""
+	try:
+		with open("/proc/self/statm") as fp:
+			return int(fp.read().split()[1]) * resource.getpagesize()
+	except (IOError, ValueError, IndexError):
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def work(conn):
+	"""
+	Worker process. Receives (filename, output) and
+	sends back (error, elapsed, rss, timings) until None is received.
+	"""
+	while True:
+		task = conn.recv()
+		if task == None:
+			break
+
+		filename, output = task
+		t = timing.monotonic()
+		error = None
+		try:
+			run_one(filename, output)
+		except SystemExit as e: # The rewriters exit on errors
+			error = "exit(%s)" % e.code
+		except Exception as e:
+			error = "%s: %s" % (type(e).__name__, e)
+		report = timing.t.report() if cfg.t.profile else None
+		conn.send((error, timing.monotonic() - t, rss(), report))
+
+class Worker:
+	def __init__(self):
+		self.conn, child_conn = multiprocessing.Pipe()
+		self.proc = multiprocessing.Process(target=work, args=(child_conn,))
+		self.proc.daemon = True
+		self.proc.start()
+		child_conn.close()
+
+		self.task = None
+		self.started = None
+		self.nr_done = 0
+		self.rss = 0
+
+	def send(self, task):
+		self.task = task
+		self.started = timing.monotonic()
+		self.conn.send(task)
+
+	def recv(self):
+		"""
+		Return (filename, error, elapsed, timings)
+		"""
+		filename, _ = self.task
+		try:
+			error, elapsed, self.rss, report = self.conn.recv()
+		except EOFError:
+			error, elapsed, report = "worker died", timing.monotonic() - self.started, None
+			self.kill()
+		self.task = None
+		self.nr_done += 1
+		return (filename, error, elapsed, report)
+
+	def stop(self):
+		if self.proc.is_alive():
+			try:
+				self.conn.send(None)
+			except IOError:
+				pass
+			self.proc.join(1)
+		self.kill()
+
+	def kill(self):
+		if self.proc.is_alive():
+			self.proc.terminate()
+		self.proc.join()
+		self.conn.close()
+
+class Batch:
+	"""
+	Process files over a pool of worker processes.
+
+	Files are scheduled largest first so that a big file
+	doesn't start last and leave the other workers idle.
+	A worker is recycled after max_files files or when its memory
+	exceeds max_rss, and killed if a file takes more than timeout seconds.
+	"""
+	def __init__(self, files, output_dir=None, nr_workers=None, timeout=None, max_files=None, max_rss=None):
+		self.files = files
+		self.output_dir = output_dir
+		self.nr_workers = nr_workers or multiprocessing.cpu_count()
+		self.timeout = timeout
+		self.max_files = max_files
+		self.max_rss = max_rss
+		self.results = [] # [(filename, error, elapsed, timings)]
+
+	def size(self, filename):
+		try:
+			return os.path.getsize(filename)
+		except OSError:
+			return 0
+
+	def shouldRecycle(self, w):
+		if not w.proc.is_alive():
+			return True
+		if self.max_files and w.nr_done >= self.max_files:
+			return True
+		if self.max_rss and w.rss > self.max_rss:
+			return True
+		return False
+
+	def done(self, result):
+		filename, error, _, _ = result
+		if error:
+			sys.stderr.write("[macroize] failed: %s (%s)\n" % (filename, error))
+		self.results.append(result)
+
+	def run(self):
+		pending = sorted(self.files, key=self.size, reverse=True)
+		pending.reverse() # pop() from the tail
+
+		workers = [Worker() for _ in range(min(self.nr_workers, len(pending)))]
+		try:
+			while True:
+				for i, w in enumerate(workers):
+					if w.task:
+						continue
+					if self.shouldRecycle(w):
+						w.stop()
+						w = workers[i] = Worker()
+					if pending:
+						filename = pending.pop()
+						w.send((filename, output_of(filename, self.output_dir)))
+
+				busy = [w for w in workers if w.task]
+				if not busy:
+					break
+
+				wait = None
+				if self.timeout:
+					now = timing.monotonic()
+					wait = max(0, min([w.started + self.timeout - now for w in busy]))
+				readable, _, _ = select.select([w.conn for w in busy], [], [], wait)
+
+				for w in busy:
+					if w.conn in readable:
+						self.done(w.recv())
+					elif self.timeout and timing.monotonic() - w.started > self.timeout:
+						w.kill()
+						filename, _ = w.task
+						w.task = None
+						self.done((filename, "timeout", self.timeout, None))
+		finally:
+			for w in workers:
+				w.stop()
+		return self
+
+	def failures(self):
+		return [filename for filename, error, _, _ in self.results if error]
+
+	def writeSummary(self, prefix):
+		"""
+		PREFIX-info.log: success rate and per-file result
+		PREFIX-failure.log: failed files, one per line (can be passed to --files-from)
+		"""
+		nr_failures = len(self.failures())
+		perc = 100.0
+		if self.results:
+			perc = 100.0 * (len(self.results) - nr_failures) / len(self.results)
+
+		with open("%s-info.log" % prefix, "w") as fp:
+			fp.write("success: %.1f%% (%d/%d)\n\n" % (perc, len(self.results) - nr_failures, len(self.results)))
+			for filename, error, elapsed, _ in sorted(self.results):
+				status = "failed (%s)" % error if error else "ok"
+				fp.write("%s %.3f[s] %s\n" % (filename, elapsed, status))
+
+		with open("%s-failure.log" % prefix, "w") as fp:
+			for filename in sorted(self.failures()):
+				fp.write("%s\n" % filename)
+		return self
+
+	def writeProfile(self, filename):
+		"""
+		The timings of all the files aggregated by timing.aggregate().
+		Files that timed out or killed the worker have no timings.
+		"""
+		reports = [report for _, _, _, report in self.results if report]
+		timing.write(filename, timing.aggregate(reports))
+		return self
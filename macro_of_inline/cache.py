@@ -0,0 +1,175 @@
+"""
+On-disk caches of --cache.
+
+Two things are cached: the parsed fake include (rewrite.fake_include_ast)
+and the whole outputs (OutputCache). The headers are not cached
+separately. They are parsed as a part of the translation unit.
+"""
+
+import cPickle as pickle
+import hashlib
+import os
+import pycparser
+
+def key_of(*xs):
+	"""
+	[Text] -> Key
+
+	The version of pycparser is always mixed because
+	the pickled ASTs depend on it.
+	"""
+	h = hashlib.sha1()
+	for x in (pycparser.__version__,) + xs:
+		h.update(x)
+		h.update('\0')
+	return h.hexdigest()
+
+class DiskCache:
+	"""
+	Persistent store of picklable objects.
+
+	Each entry is a file named after its key and the mtime of the file
+	records the last use. evict() removes the least recently used entries
+	until the total size fits in max_bytes.
+	"""
+	def __init__(self, dirname, max_bytes):
+		self.dirname = dirname
+		self.max_bytes = max_bytes
+
+	def path(self, key):
+		return os.path.join(self.dirname, "%s.pickle" % key)
+
+	def get(self, key):
+		"""
+		Return None if missing
+		"""
+		fn = self.path(key)
+		try:
+			with open(fn, "rb") as fp:
+				value = pickle.load(fp)
+			os.utime(fn, None)
+			return value
+		except IOError:
+			return None
+		except Exception:
+			# Broken entry (e.g. killed while writing by older versions)
+			self.remove(fn)
+			return None
+
+	def put(self, key, value):
+		if not os.path.exists(self.dirname):
+			try:
+				os.makedirs(self.dirname)
+			except OSError: # Other process may have created
+				pass
+
+		# Write to a temporary and rename so that concurrent readers
+		# never see a half-written entry.
+		fn = self.path(key)
+		tmp = "%s.%d.tmp" % (fn, os.getpid())
+		try:
+			with open(tmp, "wb") as fp:
+				pickle.dump(value, fp, pickle.HIGHEST_PROTOCOL)
+			os.rename(tmp, fn)
+		except Exception:
+			# Too deep ASTs can't be pickled. Just don't cache them.
+			self.remove(tmp)
+
+	def remove(self, fn):
+		try:
+			os.remove(fn)
+		except OSError:
+			pass
+
+	def evict(self):
+		if not os.path.exists(self.dirname):
+			return
+
+		entries = [] # [(mtime, size, filename)]
+		for name in os.listdir(self.dirname):
+			if not name.endswith(".pickle"):
+				continue
+			fn = os.path.join(self.dirname, name)
+			try:
+				st = os.stat(fn)
+			except OSError:
+				continue
+			entries.append((st.st_mtime, st.st_size, fn))
+
+		total = sum([size for _, size, _ in entries])
+		for _, size, fn in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			self.remove(fn)
+			total -= size
+
+def file_digest(filename):
+	"""
+	Return None if the file can't be read
+	"""
+	try:
+		with open(filename, "rb") as fp:
+			return hashlib.sha1(fp.read()).hexdigest()
+	except IOError:
+		return None
+
+code_digests = {} # directory -> digest
+
+def code_digest():
+	"""
+	Digest of the code of macro-of-inline (the .py files of this package)
+	so that the outputs of other versions are never reused
+	"""
+	dirname = os.path.dirname(os.path.abspath(__file__))
+	if not dirname in code_digests:
+		h = hashlib.sha1()
+		for fn in sorted(os.listdir(dirname)):
+			if fn.endswith(".py"):
+				h.update(fn)
+				h.update('\0')
+				h.update(file_digest(os.path.join(dirname, fn)) or "")
+		code_digests[dirname] = h.hexdigest()
+	return code_digests[dirname]
+
+class OutputCache:
+	"""
+	Cache of whole-file results like ccache's direct mode.
+
+	The manifest, keyed by the source text and the options, lists the
+	include closure of the last run as [(file, digest)]. If none of the
+	files has changed since, the result stored for the manifest is valid.
+	Results are ("ok", output) or ("error", None) so that the files
+	known to fail to parse are not processed again.
+	The code of macro-of-inline is a part of the key.
+	"""
+	def __init__(self, dirname, max_bytes, options):
+		self.store = DiskCache(dirname, max_bytes)
+		self.options = options
+
+	def manifestKey(self, src_txt):
+		return key_of("manifest", code_digest(), self.options, src_txt)
+
+	def resultKey(self, mkey, manifest):
+		return key_of("result", mkey, repr(manifest))
+
+	def lookup(self, src_txt):
+		"""
+		Return None if missing or stale
+		"""
+		mkey = self.manifestKey(src_txt)
+		manifest = self.store.get(mkey)
+		if manifest == None:
+			return None
+		for fn, digest in manifest:
+			if file_digest(fn) != digest:
+				return None
+		return self.store.get(self.resultKey(mkey, manifest))
+
+	def manifestOf(self, closure):
+		return [(fn, file_digest(fn)) for fn in sorted(closure)]
+
+	def save(self, src_txt, manifest, result):
+		mkey = self.manifestKey(src_txt)
+		self.store.put(mkey, manifest)
+		self.store.put(self.resultKey(mkey, manifest), result)
+		self.store.evict()
@@ -0,0 +1,102 @@
+import json
+import os
+
+class Profile:
+	"""
+	Call counts measured by a profiler (e.g. gprof, perf).
+
+	A call site is hot if the count of its (caller, callee) pair
+	reaches the threshold. Without the count of the pair,
+	the sample weight of the caller is used instead.
+	"""
+	def __init__(self, threshold):
+		self.threshold = threshold
+		self.calls = {} # (caller, callee) -> count
+		self.weights = {} # function -> weight
+
+	def addCall(self, caller, callee, count):
+		self.calls[(caller, callee)] = self.calls.get((caller, callee), 0) + count
+
+	def addWeight(self, func, weight):
+		self.weights[func] = self.weights.get(func, 0) + weight
+
+	def isHot(self, caller, callee):
+		count = self.calls.get((caller, callee))
+		if count is None:
+			count = self.weights.get(caller, 0)
+		return count >= self.threshold
+
+def parse_text(txt, profile):
+	"""
+	One record per line. Blank lines and lines starting with # are ignored.
+
+	caller callee count
+	function weight
+	"""
+	for lineno, line in enumerate(txt.splitlines(), 1):
+		xs = line.split()
+		if not xs or xs[0].startswith("#"):
+			continue
+		if len(xs) == 3:
+			profile.addCall(xs[0], xs[1], float(xs[2]))
+		elif len(xs) == 2:
+			profile.addWeight(xs[0], float(xs[1]))
+		else:
+			raise ValueError("line %d: expected 'caller callee count' or 'function weight'" % lineno)
+
+def parse_json(txt, profile):
+	"""
+	{
+	  "calls": [{"caller": "main", "callee": "f", "count": 100}, ["main", "g", 10], ...],
+	  "functions": {"main": 1000, ...}
+	}
+	"""
+	o = json.loads(txt)
+	for call in o.get("calls", []):
+		if isinstance(call, dict):
+			profile.addCall(call["caller"], call["callee"], float(call["count"]))
+		else:
+			caller, callee, count = call
+			profile.addCall(caller, callee, float(count))
+	for func, weight in o.get("functions", {}).items():
+		profile.addWeight(func, float(weight))
+
+profiles = {} # (path, mtime, size, threshold) -> Profile
+
+def load(filename, threshold):
+	"""
+	File -> Profile
+
+	The format (JSON or text) is guessed from the content.
+	A profile is loaded once in a process.
+	"""
+	st = os.stat(filename)
+	memo_key = (os.path.abspath(filename), st.st_mtime, st.st_size, threshold)
+	if memo_key in profiles:
+		return profiles[memo_key]
+
+	with open(filename) as fp:
+		txt = fp.read()
+
+	profile = Profile(threshold)
+	if txt.lstrip().startswith("{"):
+		parse_json(txt, profile)
+	else:
+		parse_text(txt, profile)
+
+	profiles[memo_key] = profile
+	return profile
+
+if __name__ == "__main__":
+	p = Profile(10)
+	parse_text("# caller callee count\nmain f 100\nmain g 1\nh 50\n", p)
+	assert(p.isHot("main", "f"))
+	assert(not p.isHot("main", "g"))
+	assert(p.isHot("h", "g"))
+	assert(not p.isHot("k", "f"))
+
+	p = Profile(10)
+	parse_json('{"calls": [{"caller": "main", "callee": "f", "count": 100}, ["main", "g", 1]], "functions": {"h": 50}}', p)
+	assert(p.isHot("main", "f"))
+	assert(not p.isHot("main", "g"))
+	assert(p.isHot("h", "g"))
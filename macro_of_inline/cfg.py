@@ -2,10 +2,20 @@ class Env:
 	def __init__(self):
 		self.record_enabled = False
 		self.record_dir = "/tmp/record-macro-of-inline"
+		self.profile = None # File to write the timings into
 		self.with_cpp = False
 		self.cpp_mode = None
 		self.extra_options = []
 		self.inline_mask = 7
+		self.max_inline_depth = 8
+		self.max_inline_growth = 20000 # AST nodes
+		self.call_profile = None
+		self.hot_threshold = 1
 		self.fake_include = None
+		self.lazy = False
+		self.jobs = 1
+		self.cache_enabled = False
+		self.cache_dir = "/tmp/cache-macro-of-inline"
+		self.cache_size = 256 * 1024 * 1024 # bytes
 
 t = Env()
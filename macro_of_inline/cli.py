@@ -0,0 +1,123 @@
+import argparse
+import sys
+
+import cfg
+
+VERSION = "0.9"
+DEFAULT_SOCKET = "/tmp/macro-of-inline.sock"
+
+def argument_parser():
+	parser = argparse.ArgumentParser(prog="macro-of-inline", version=VERSION, description="C Preprocessor to translate functions to equivalent macros")
+	parser.add_argument("i", metavar="INFILE", nargs="*", help="input file. by default, already preprocessed (see --with-cpp)")
+	parser.add_argument("-o", metavar="OUTFILE", help="output (default:-). [--batch] output directory (default: overwrite the input files)", default="-")
+	parser.add_argument("--with-cpp", nargs='?', help="without this flag, the input needs to be explicitly preprocessed. but with this flag, the input file will be implicitly preprocessed within this program. note that, the default mode works tricky thus it's not always work. it depends on how tedious the input file is. gcc mode is experimental and only for testing", const='--', choices=['--', 'gcc'])
+	parser.add_argument("-X", "--cpp-args", nargs="+", metavar="OPTION", help="[--with-cpp] extra options to preprocessor (e.g. _Ipath _DHOGE)", default=[])
+	parser.add_argument("-O", metavar="MASK", help="mask to determine the chance of inlining. static inline = 1, inline = 2, static = 4 (default:7)", default=7)
+	parser.add_argument("--max-inline-depth", metavar="N", type=int, help="limit the nesting of the macros expanded at a call site. the calls beyond the limit are left as function calls (default:8)", default=8)
+	parser.add_argument("--max-inline-growth", metavar="N", type=int, help="limit how many AST nodes the expanded macros can add to a function. the calls beyond the limit are left as function calls (default:20000)", default=20000)
+	parser.add_argument("--call-profile", metavar="FILE", help="macroize only the hot call sites in the profile. the profile is text (lines of 'caller callee count' or 'function weight') or JSON ({\"calls\": [{\"caller\": .., \"callee\": .., \"count\": ..}], \"functions\": {name: weight}})")
+	parser.add_argument("--hot-threshold", metavar="N", type=float, help="[--call-profile] a call site is hot if the count of the caller-callee pair (or the weight of the caller) is N or more (default:1)", default=1)
+	parser.add_argument("--fake-include", metavar="FILE", help="fake include to deceive pycparser by adding fake typedefs")
+	parser.add_argument("--lazy", action="store_true", help="parse only the function bodies that can mention a macroizable function. the other bodies are copied to the output as they are")
+	parser.add_argument("--record", nargs='?', metavar="DIR", help="record the tracks of code translation. specify a directory if you don't want to use the default directory (default:/tmp/record-macro-of-inline)", const="/tmp/record-macro-of-inline")
+	parser.add_argument("--profile", metavar="FILE", help="write the elapsed time of every phase and subprocess call into FILE as JSON. [--batch] the times are aggregated over the files to find the slowest files and phases")
+	parser.add_argument("--cache", nargs='?', metavar="DIR", help="cache the parsed fake include and the outputs on disk. unchanged files (including the headers they include) are not processed again, and neither are the files that failed to parse. specify a directory if you don't want to use the default directory (default:/tmp/cache-macro-of-inline)", const="/tmp/cache-macro-of-inline")
+	parser.add_argument("--cache-size", metavar="MB", type=int, help="[--cache] size limit of the cache. least recently used entries are evicted (default:256)", default=256)
+	parser.add_argument("--batch", action="store_true", help="process many files in parallel. INFILEs can be directories to be searched for .c files")
+	parser.add_argument("--files-from", metavar="LIST", help="[--batch] file that lists input files, one per line")
+	parser.add_argument("-j", metavar="N", type=int, help="number of worker processes to rewrite the functions in parallel (default:1). [--batch] files are processed in parallel instead (default: number of cpus)")
+	parser.add_argument("--timeout", metavar="SEC", type=float, help="[--batch] time limit per file (default: no limit)")
+	parser.add_argument("--max-files", metavar="N", type=int, help="[--batch] recycle a worker after processing N files (default: no limit)")
+	parser.add_argument("--max-rss", metavar="MB", type=int, help="[--batch] recycle a worker when its memory usage exceeds MB (default: no limit)")
+	parser.add_argument("--log", metavar="PREFIX", help="[--batch] write the summary into PREFIX-info.log and PREFIX-failure.log (default:macro-of-inline)", default="macro-of-inline")
+	parser.add_argument("--server", nargs='?', metavar="SOCKET", help="run as a server that takes requests from macro-of-inline-client. the other options are the defaults for warming up (default:%s)" % DEFAULT_SOCKET, const=DEFAULT_SOCKET)
+	return parser
+
+def parse(argv):
+	parser = argument_parser()
+	args = parser.parse_args(argv)
+
+	if args.server:
+		if args.i or args.batch:
+			parser.error("--server takes no INFILE")
+	elif args.batch:
+		if not (args.i or args.files_from):
+			parser.error("--batch requires INFILEs or --files-from")
+		if args.record:
+			parser.error("--record can't be used with --batch")
+	elif len(args.i) != 1:
+		parser.error("exactly one INFILE is required without --batch")
+	return args
+
+def configure(args):
+	"""
+	Set up a new cfg.t from the arguments
+	"""
+	cfg.t = cfg.Env()
+
+	cfg.t.extra_options = args.cpp_args
+	cfg.t.inline_mask = args.O
+	cfg.t.max_inline_depth = args.max_inline_depth
+	cfg.t.max_inline_growth = args.max_inline_growth
+	cfg.t.call_profile = args.call_profile
+	cfg.t.hot_threshold = args.hot_threshold
+	cfg.t.fake_include = args.fake_include
+	cfg.t.lazy = args.lazy
+
+	if args.with_cpp:
+		cfg.t.with_cpp = True
+		cfg.t.cpp_mode = args.with_cpp
+
+	if args.j and not args.batch:
+		cfg.t.jobs = args.j
+
+	if args.record:
+		cfg.t.record_enabled = True
+		cfg.t.record_dir = args.record
+
+	if args.cache:
+		cfg.t.cache_enabled = True
+		cfg.t.cache_dir = args.cache
+	cfg.t.cache_size = args.cache_size * 1024 * 1024
+
+	cfg.t.profile = args.profile
+
+def run(args):
+	"""
+	Return the exit code
+	"""
+	# rewrite_file module imports recorder module and
+	# recorder module shouldn't be imported before cfg.t is all set.
+	if args.batch:
+		import batch
+		files = batch.collect(args.i, args.files_from)
+		output_dir = None if args.o == "-" else args.o
+		max_rss = args.max_rss * 1024 * 1024 if args.max_rss else None
+		runner = batch.Batch(files, output_dir, args.j, args.timeout, args.max_files, max_rss)
+		runner.run().writeSummary(args.log)
+		if args.profile:
+			runner.writeProfile(args.profile)
+		return 1 if runner.failures() else 0
+
+	import rewrite
+	import timing
+	import utils
+	runner = rewrite.Main(args.i[0])
+	if args.o == "-":
+		runner.emit(sys.stdout)
+	else:
+		utils.write_file(args.o, runner.emit)
+	if args.profile:
+		timing.write(args.profile, timing.t.report())
+	return 0
+
+def main(argv):
+	args = parse(argv)
+	configure(args)
+
+	if args.server:
+		import server
+		server.serve(args.server)
+		return 0
+
+	return run(args)
@@ -1,6 +1,5 @@
 from pycparser import c_ast, c_parser, c_generator
 
-import copy
 import ext_pycparser
 
 def mk(xs):
@@ -99,13 +98,47 @@ class NodeVisitor(ext_pycparser.NodeVisitor):
 		# print(type(n))
 		self.visit(n.stmt)
 
-class SymbolTable:
+class Scopes:
+	"""
+	Names visible from the current block.
+
+	All the scopes share one table.
+	Entering a block pushes an empty undo log and
+	a binding records the one it hides into the log.
+	Leaving the block replays the log,
+	so both are O(1) regardless of the number of names.
+	"""
 	def __init__(self):
-		self.names = set()
-		self.prev_table = None
+		self.table = {}
+		self.undo_logs = [] # [[(name, hidden binding or None)]]
+
+	def level(self):
+		return len(self.undo_logs)
+
+	def bind(self, name, value):
+		if self.undo_logs:
+			self.undo_logs[-1].append((name, self.table.get(name)))
+		self.table[name] = value
 
+	def lookup(self, name):
+		return self.table.get(name)
+
+	def __contains__(self, name):
+		return name in self.table
+
+	def push(self):
+		self.undo_logs.append([])
+
+	def pop(self):
+		for name, hidden in reversed(self.undo_logs.pop()):
+			if hidden is None:
+				del self.table[name]
+			else:
+				self.table[name] = hidden
+
+class SymbolTable(Scopes):
 	def register(self, name):
-		self.names.add(name)
+		self.bind(name, True)
 
 	def register_args(self, func):
 		if ext_pycparser.FuncDef(func).voidArgs():
@@ -118,29 +151,24 @@ class SymbolTable:
 				continue
 			self.register(param_decl.name)
 
-	def clone(self):
-		st = SymbolTable()
-		st.names = copy.deepcopy(self.names)
-		return st
-
 	def switch(self):
 		"""
 		usage:
 		current_table = current_table.switch()
 		"""
-		new_table = self.clone()
-		new_table.prev_table = self
-		return new_table
+		self.push()
+		return self
 
 	def revert(self):
 		"""
 		usage:
 		current_table = current_table.revert()
 		"""
-		return self.prev_table
+		self.pop()
+		return self
 
 	def show(self):
-		print(self.names)
+		print(self.table.keys())
 
 class SymbolTableMixin:
 	def __init__(self, func, macroizables):
@@ -150,7 +178,7 @@ class SymbolTableMixin:
 		self.current_table.register_args(func)
 
 	def canMacroize(self, name):
-		return name in self.macroizables - self.current_table.names
+		return name in self.macroizables and not name in self.current_table
 
 	def register(self, decl):
 		self.current_table.register(decl.name)
@@ -162,7 +190,7 @@ class SymbolTableMixin:
 		self.current_table = self.current_table.revert()
 
 	def currentSymbols(self):
-		return self.current_table.names
+		return self.current_table
 
 class AllFuncCalls(NodeVisitor):
 	def __init__(self):
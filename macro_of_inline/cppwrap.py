@@ -2,10 +2,13 @@ from pycparser import c_ast
 
 import enum
 import os
+import re
 import cfg
 import ext_pycparser
 import pycparser
 import recorder
+import StringIO
+import timing
 import utils
 
 def cpp(filename):
@@ -48,6 +51,28 @@ def analyzeInclude(filename, txt):
 			current_result.append(line)
 	return result
 
+LINE_MARKER = re.compile(r'^\s*#\s*(line\s+)?\d+\s+"([^"]*)"')
+
+def include_closure(txt):
+	"""
+	Text -> set(File)
+
+	All the files that the line markers of cpp refer to.
+	Both "#line N FILE" (mcpp) and "# N FILE FLAGS" (gcc) are understood.
+	"""
+	result = set()
+	for line in txt.splitlines():
+		if not line.lstrip().startswith("#"):
+			continue
+		m = LINE_MARKER.match(line)
+		if not m:
+			continue
+		fn = m.group(2)
+		if fn.startswith("<"): # <built-in>, <command-line>
+			continue
+		result.add(os.path.abspath(fn))
+	return result
+
 def compare_asts(ast1, ast2):
 	if type(ast1) != type(ast2):
 		return False
@@ -79,22 +104,40 @@ def compare_asts(ast1, ast2):
 
 	return True
 
+def fingerprint(ast):
+	"""
+	Structural hash that follows the rules of compare_asts.
+	compare_asts(a, b) implies fingerprint(a) == fingerprint(b).
+	"""
+	if isinstance(ast, c_ast.FuncDef):
+		return hash((c_ast.FuncDef, ast.decl.name))
+
+	attrs = tuple([repr(getattr(ast, attr)) for attr in ast.attr_names])
+	children = tuple([(name, fingerprint(c)) for name, c in ast.children()])
+	return hash((type(ast), attrs, children))
+
 class ASTDiff:
+	"""
+	Multiset of ASTs.
+	ASTs are bucketed by fingerprint so that
+	compare_asts only runs against the candidates of the same hash.
+	"""
 	def __init__(self):
-		self.asts = [] # [[ast, count]]
+		self.asts = {} # fingerprint -> [[ast, count]]
 
 	def inc(self, ast):
-		for e in self.asts:
+		bucket = self.asts.setdefault(fingerprint(ast), [])
+		for e in bucket:
 			if compare_asts(e[0], ast):
 				e[1] += 1
 				return
-		self.asts.append([ast, 1])
+		bucket.append([ast, 1])
 
 	def dec(self, ast):
 		"""
 		Return true iff the ast exists (count > 0)
 		"""
-		for e in self.asts:
+		for e in self.asts.get(fingerprint(ast), []):
 			if compare_asts(e[0], ast):
 				if (e[1] > 0):
 					e[1] -= 1
@@ -116,26 +159,43 @@ def ast_delete(a, b):
 	for n in b.ext:
 		diff.inc(n)
 
-	delete_indices = []
+	splice = ext_pycparser.Splice(a.ext)
 	for i, n in enumerate(a.ext):
 		if diff.dec(n):
-			delete_indices.append(i)
-
-	for i in reversed(delete_indices):
-		del(a.ext[i])
+			splice.delete(i)
+	splice.apply()
 
 class Apply:
 	"""
-	(AST -> AST) -> File -> Text
+	(Text -> AST) -> File -> Text
 
 	The file (of filename) can be before preprocessing.
 	It can contains directives.
+
+	f must leave out the nodes of the included headers (see rewrite.Wrap).
+	They are replaced by the directives that include them.
 	"""
 	def __init__(self, f):
 		self.f = f
 
 	def on(self, filename):
-		cpped_txt = cpp(filename)
+		return self.onText(filename, cpp(filename))
+
+	def onText(self, filename, cpped_txt):
+		"""
+		Same as on() but the file is already preprocessed by cpp()
+		"""
+		fp = StringIO.StringIO()
+		out = ext_pycparser.CleanUp(fp)
+		self.emitText(filename, cpped_txt, out)
+		out.close()
+		return fp.getvalue()
+
+	def emitText(self, filename, cpped_txt, out):
+		"""
+		Same as onText() but the text is written into out
+		one top-level node at a time. out is usually ext_pycparser.CleanUp.
+		"""
 		recorder.t.file_record("preprocessed", cpped_txt)
 		# print(cpped_txt)
 
@@ -147,29 +207,26 @@ class Apply:
 		orig_txt_lines = fp.read().splitlines()
 		fp.close()
 		included_headers = []
-		included_codes = []
-		for lineno, code in	includes:
+		for lineno, _ in includes:
 			included_headers.append(orig_txt_lines[lineno - 1])
-			included_codes.append('\n'.join(code))
-		# print(included_codes)
-		# print(included_headers)	
+		# print(included_headers)
 
 		ast_a = self.f(cpped_txt)
 
-		ast_b = ext_pycparser.ast_of('\n'.join(included_codes))
-		ast_delete(ast_a, ast_b)
-		recorder.t.file_record("delete_included_decls", ext_pycparser.CGenerator().visit(ast_a))
-
-		contents = ext_pycparser.CGenerator().visit(ast_a)
-
-		contents =  """
-%s
-%s
+		def write(fp):
+			fp.write("\n%s\n" % '\n'.join(included_headers))
+			ext_pycparser.CGenerator().emit(ast_a, fp)
+			# A blank line at the end
+			fp.write("\n" if ast_a.ext else "\n\n")
 
-""" % ('\n'.join(included_headers), ext_pycparser.CGenerator.cleanUp(contents))
+		with timing.t.phase("generate"):
+			write(out)
 
+		def contents():
+			buf = StringIO.StringIO()
+			write(buf)
+			return ext_pycparser.CGenerator.cleanUp(buf.getvalue())
 		recorder.t.file_record("union_header_directives", contents)
-		return contents
 
 if __name__ == "__main__":
 	testcase = r"""
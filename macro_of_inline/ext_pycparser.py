@@ -1,7 +1,11 @@
 from pycparser import c_ast, c_parser, c_generator
 
+import cfg
 import enum
+import os
 import re
+import sys
+import threading
 
 class Result:
 	def __init__(self, visitor):
@@ -11,9 +15,66 @@ class Result:
 		self.visitor.visit(n)
 		return self.visitor.result
 
+def parser_tables():
+	"""
+	() -> (lextab, yacctab, outputdir)
+
+	Use the precompiled tables shipped with pycparser if they exist.
+	Otherwise the tables are generated once into the cache directory
+	and imported from there by the later runs.
+	"""
+	try:
+		import pycparser.lextab
+		import pycparser.yacctab
+		return ('pycparser.lextab', 'pycparser.yacctab', '')
+	except ImportError:
+		pass
+
+	outputdir = os.path.join(cfg.t.cache_dir, "tables")
+	if not os.path.exists(outputdir):
+		os.makedirs(outputdir)
+	if not outputdir in sys.path:
+		sys.path.insert(0, outputdir)
+	return ('macro_of_inline_lextab', 'macro_of_inline_yacctab', outputdir)
+
+class ParserPool:
+	"""
+	Process-wide pool of CParsers.
+
+	Constructing a CParser sets up the lexer and the LALR tables
+	and it costs far more than parsing a small text.
+	A parser is reusable after the parse finishes so we keep the idle ones.
+	No parser is built until the first ast_of() call.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.idle = []
+		self.tables = None
+
+	def newParser(self):
+		if not self.tables:
+			self.tables = parser_tables()
+		lextab, yacctab, outputdir = self.tables
+		return c_parser.CParser(lextab=lextab, yacctab=yacctab, taboutputdir=outputdir)
+
+	def acquire(self):
+		with self.lock:
+			if self.idle:
+				return self.idle.pop()
+		return self.newParser()
+
+	def release(self, parser):
+		with self.lock:
+			self.idle.append(parser)
+
+parser_pool = ParserPool()
+
 def ast_of(txt):
-	parser = c_parser.CParser()
-	return parser.parse(txt)
+	parser = parser_pool.acquire()
+	try:
+		return parser.parse(txt)
+	finally:
+		parser_pool.release(parser)
 
 class Any(c_ast.Node):
 	"""
@@ -40,6 +101,135 @@ class CommaOp(c_ast.Node):
 
 	attr_names = ('exprs',)
 
+class Macro(c_ast.Node):
+	"""
+	Macroized function kept in AST so that it can be expanded without cpp.
+
+	#define $name(namespace, $params) \\
+	do { \\
+	$body \\
+	} while(0)
+	"""
+	def __init__(self, name, params, body, coord=None):
+		self.name = name
+		self.params = params
+		self.body = body
+		self.coord = coord
+
+	def children(self):
+		nodelist = []
+		if self.body is not None: nodelist.append(("body", self.body))
+		return tuple(nodelist)
+
+	attr_names = ('name', 'params',)
+
+node_attrs = {} # class -> [attribute]
+
+def attributes(n):
+	"""
+	pycparser's nodes have __slots__ and ours have __dict__
+	"""
+	cls = type(n)
+	if not cls in node_attrs:
+		names = []
+		for c in cls.__mro__:
+			names.extend([x for x in c.__dict__.get("__slots__", ()) if x != "__weakref__"])
+		node_attrs[cls] = names
+	if hasattr(n, "__dict__"):
+		return node_attrs[cls] + n.__dict__.keys()
+	return node_attrs[cls]
+
+def clone(n):
+	"""
+	Same as copy.deepcopy() of an AST but much faster.
+
+	Nodes and lists are copied. The other values (names, constants and coords)
+	are shared because no pass changes them in place.
+	"""
+	if isinstance(n, list):
+		return [clone(x) for x in n]
+	if not isinstance(n, c_ast.Node):
+		return n
+	m = object.__new__(type(n))
+	for name in attributes(n):
+		setattr(m, name, clone(getattr(n, name)))
+	return m
+
+def copy_node(n):
+	"""
+	Copy of the node itself. The children are shared.
+	"""
+	m = object.__new__(type(n))
+	for name in attributes(n):
+		x = getattr(n, name)
+		setattr(m, name, list(x) if isinstance(x, list) else x)
+	return m
+
+def clone_declarator(n):
+	"""
+	Copy only the declarator nodes of a type, which RewriteTypeDecl renames:
+	int *f() -> int *x
+
+	The base type (e.g. struct) is shared. A function type is copied
+	as a whole because the names of its parameters are renamed too.
+	"""
+	if not isinstance(n, (c_ast.TypeDecl, c_ast.PtrDecl, c_ast.ArrayDecl)):
+		return clone(n)
+	m = copy_node(n)
+	if not isinstance(n, c_ast.TypeDecl):
+		m.type = clone_declarator(n.type)
+	if isinstance(n, c_ast.ArrayDecl):
+		m.dim = clone(n.dim) # RewriteTypeDecl visits the dimension too
+	return m
+
+class Splice:
+	"""
+	Planned edits of a list (e.g. FileAST.ext, Compound.block_items)
+	applied in one linear pass.
+
+	Positions are the indices in the list before any edit.
+	Inserted items are placed before the item at the position
+	in the order they are planned.
+	"""
+	def __init__(self, xs):
+		self.xs = xs
+		self.inserts = {} # i -> [x]
+		self.deletes = set() # i
+
+	def insert(self, i, x):
+		self.inserts.setdefault(i, []).append(x)
+
+	def delete(self, i):
+		self.deletes.add(i)
+
+	def move(self, i, j):
+		"""
+		Move xs[i] before xs[j]
+		"""
+		self.insert(j, self.xs[i])
+		self.delete(i)
+
+	def empty(self):
+		return not (self.inserts or self.deletes)
+
+	def apply(self):
+		"""
+		The list is rebuilt in place
+		"""
+		if self.empty():
+			return self.xs
+		result = []
+		for i, x in enumerate(self.xs):
+			if i in self.inserts:
+				result.extend(self.inserts[i])
+			if not i in self.deletes:
+				result.append(x)
+		result.extend(self.inserts.get(len(self.xs), []))
+		self.xs[:] = result
+		self.inserts = {}
+		self.deletes = set()
+		return self.xs
+
 class CGenerator(c_generator.CGenerator):
 	"""
 	Since we don't modify the upstream CGenerator
@@ -62,6 +252,19 @@ class CGenerator(c_generator.CGenerator):
 	def visit_CommaOp(self, n):
 		return "(" + self.visit(n.exprs) + ")"
 
+	def visit_Macro(self, n):
+		args = ', '.join(["namespace"] + n.params)
+		body_contents = CGenerator().visit(n.body).splitlines()[1:-1]
+		if not len(body_contents):
+			body_contents = [""]
+		body = '\n'.join(map(lambda x: "%s \\" % x, body_contents))
+		return r"""
+#define %s(%s) \
+do { \
+%s
+} while(0)
+""" % (n.name, args, body)
+
 	@classmethod
 	def cleanUp(cls, txt):
 		"""
@@ -69,6 +272,51 @@ class CGenerator(c_generator.CGenerator):
 		"""
 		return '\n'.join([line for line in txt.splitlines() if line != ";"])
 
+	def emit(self, ast, fp):
+		"""
+		Write the same text as visit(ast) into fp one top-level node at a time
+		"""
+		for ext in ast.ext:
+			if isinstance(ext, c_ast.FuncDef):
+				fp.write(self.visit(ext))
+			else:
+				fp.write(self.visit(ext) + ';\n')
+
+class CleanUp:
+	"""
+	File-like writer that does CGenerator.cleanUp() on the fly.
+
+	The text written into fp after close() is the same as
+	cleanUp() of all the text given to write(). Only the last incomplete
+	line is kept in memory.
+	"""
+	def __init__(self, fp):
+		self.fp = fp
+		self.tail = ""
+		self.empty = True
+
+	def writeLines(self, lines):
+		lines = [line for line in lines if line != ";"]
+		if not lines:
+			return
+		if not self.empty:
+			self.fp.write('\n')
+		self.fp.write('\n'.join(lines))
+		self.empty = False
+
+	def write(self, txt):
+		segments = (self.tail + txt).split('\n')
+		self.tail = segments.pop()
+		lines = []
+		for segment in segments:
+			# Other line boundaries (e.g. "\r") are split as splitlines() does
+			lines.extend(segment.splitlines() or [""])
+		self.writeLines(lines)
+
+	def close(self):
+		self.writeLines(self.tail.splitlines())
+		self.tail = ""
+
 class NodeVisitor(c_ast.NodeVisitor):
 
 	def visit(self, node):
@@ -255,6 +503,31 @@ class ParamDecl:
 class FileAST:
 	pass
 
+class AllIdentifiers(c_ast.NodeVisitor):
+	"""
+	AST -> set(identifier)
+
+	Every name in the AST, including the names of the variables, types,
+	struct/union/enum tags, fields, labels and the words in Any texts.
+	"""
+	WORD = re.compile(r"[A-Za-z_]\w*")
+
+	def __init__(self):
+		self.result = set()
+
+	def generic_visit(self, node):
+		for attr in ("name", "declname", "field"):
+			x = getattr(node, attr, None)
+			if isinstance(x, str):
+				self.result.add(x)
+		names = getattr(node, "names", None)
+		if isinstance(names, list):
+			self.result.update([x for x in names if isinstance(x, str)])
+		text = getattr(node, "text", None)
+		if isinstance(text, str):
+			self.result.update(self.WORD.findall(text))
+		c_ast.NodeVisitor.generic_visit(self, node)
+
 class AllFuncCalls(NodeVisitor):
 	def __init__(self):
 		self.result = []
@@ -271,6 +544,46 @@ class T:
 		self.y = 10
 
 if __name__ == "__main__":
+	xs = [0, 1, 2, 3]
+	splice = Splice(xs)
+	splice.move(2, 0)
+	splice.insert(0, 4)
+	splice.delete(1)
+	splice.insert(4, 5)
+	assert(splice.apply() == [2, 4, 0, 3, 5])
+
+	ast = ast_of("struct T { int x; }; struct T *(*f(int a[2]))[3];")
+	decl = ast.ext[1]
+	text = CGenerator().visit(ast)
+	t = clone(decl)
+	assert(CGenerator().visit(t) == CGenerator().visit(decl))
+	RewriteTypeDecl("g").visit(t.type)
+	t.type.args.params[0].name = "b"
+	assert(CGenerator().visit(ast) == text)
+
+	t = clone_declarator(decl.type.type)
+	RewriteTypeDecl("x").visit(t)
+	assert(CGenerator().visit(ast) == text)
+	assert(CGenerator().visit(c_ast.Decl("x", [], [], [], t, None, None)) == "struct T *(*x)[3]")
+
+	# The parameters of a returned function pointer are not shared
+	ast = ast_of("static int (*getf(int k))(int x) { return 0; }")
+	text = CGenerator().visit(ast)
+	t = clone_declarator(ast.ext[0].decl.type.type)
+	t.type.args.params[0].name = "y"
+	RewriteTypeDecl("y").visit(t.type.args.params[0])
+	assert(CGenerator().visit(ast) == text)
+
+	import StringIO
+	for txt in ["", "\n", "a\n;\nb", "a\n\n;\n", "a\r\n;\r\nb\rc\n\n"]:
+		for size in [1, 2, 100]:
+			fp = StringIO.StringIO()
+			out = CleanUp(fp)
+			for i in range(0, len(txt), size):
+				out.write(txt[i:i+size])
+			out.close()
+			assert(fp.getvalue() == CGenerator.cleanUp(txt))
+
 	t = T()
 	NodeVisitor.rewrite(t, "xs[1]", 4)
 	assert(t.xs[1] == 4)
@@ -0,0 +1,248 @@
+"""
+Lazy parsing of the function bodies.
+
+Most of the functions in a translation unit are neither macroizable
+nor callers of one. Their bodies are never rewritten so parsing them
+into AST nodes (and walking and regenerating the nodes) is a waste.
+
+Before parsing, the text is scanned for the top-level function definitions.
+A function can be macroized only if it is static or inline (see
+rewrite.FuncDef.inline_bit) and a body is rewritten only if it mentions
+the name of such a function. The other bodies are replaced by placeholders
+and become Any nodes of their original text after parsing.
+"""
+
+from pycparser import c_ast
+
+import ext_pycparser
+import re
+import timing
+
+# Tokens that matter to find the function bodies at top level
+TOP = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|/\*.*?\*/|//[^\n]*|^[ \t]*#[^\n]*|[{}();=]', re.M | re.S)
+
+# Tokens that matter to find the end of a body
+BODY = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|/\*.*?\*/|//[^\n]*|^[ \t]*#[^\n]*|[{}]', re.M | re.S)
+
+WORD = re.compile(r"[A-Za-z_]\w*")
+CALLEE = re.compile(r"([A-Za-z_]\w*)\s*\(")
+LINE_MARKER = re.compile(r"^[ \t]*#[ \t]*(?:line\b|\d)[^\n]*\n?", re.M)
+NOISE = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|/\*.*?\*/|//[^\n]*|^[ \t]*#[^\n]*', re.M | re.S)
+
+MACROIZABLE = set(["static", "inline", "__inline", "__inline__"])
+
+KEYWORDS = set("""
+auto break case char const continue default do double else enum extern
+float for goto if inline int long register restrict return short signed
+sizeof static struct switch typedef union unsigned void volatile while
+_Bool _Complex __attribute__ __asm__ __declspec __extension__ __typeof__ typeof
+""".split())
+
+PLACEHOLDER = "__macro_of_inline_lazy_%d"
+
+class Function:
+	"""
+	Function definition found by the scan
+	"""
+	def __init__(self, txt, start, begin, end):
+		self.header = NOISE.sub(" ", txt[start:begin])
+		self.body = txt[begin:end]
+		self.begin = begin # {
+		self.end = end # next to }
+		self.words = set(WORD.findall(self.header))
+
+	def name(self):
+		for name in CALLEE.findall(self.header):
+			if not name in KEYWORDS:
+				return name
+		return None
+
+	def isCandidate(self):
+		return bool(self.words & MACROIZABLE)
+
+def find_body_end(txt, pos):
+	"""
+	Position of the { -> position next to the matching }
+	"""
+	depth = 0
+	m = BODY.search(txt, pos)
+	while m:
+		tok = m.group()
+		if tok == "{":
+			depth += 1
+		elif tok == "}":
+			depth -= 1
+			if depth == 0:
+				return m.end()
+		m = BODY.search(txt, m.end())
+	return None
+
+def scan(txt):
+	"""
+	Text -> [Function]
+
+	Only the definitions of the pattern "... ) {" at top level are found.
+	The others (e.g. K&R style definitions) are left to the parser.
+	"""
+	result = []
+	paren = 0
+	brace = 0
+	last = None
+	assigned = False
+	start = 0 # of the current top-level declaration
+	m = TOP.search(txt)
+	while m:
+		tok = m.group()
+		pos = m.end()
+		if len(tok) > 1:
+			m = TOP.search(txt, pos)
+			continue
+
+		if tok == "(":
+			paren += 1
+		elif tok == ")":
+			paren -= 1
+		elif tok == "=" and paren == 0 and brace == 0:
+			assigned = True
+		elif tok == ";" and paren == 0 and brace == 0:
+			start = pos
+			assigned = False
+		elif tok == "{":
+			if paren == 0 and brace == 0 and last == ")" and not assigned:
+				end = find_body_end(txt, m.start())
+				if end is None:
+					return []
+				result.append(Function(txt, start, m.start(), end))
+				start = pos = end
+				last = "}"
+				m = TOP.search(txt, pos)
+				continue
+			brace += 1
+		elif tok == "}":
+			brace -= 1
+		last = tok
+		m = TOP.search(txt, pos)
+	return result
+
+def opaque_text(body):
+	"""
+	The body as it is emitted. The line markers are dropped and
+	the lines of a semicolon are kept from CGenerator.cleanUp.
+	A newline is appended as CGenerator does for Compound.
+	"""
+	lines = LINE_MARKER.sub("", body).split("\n")
+	return "\n".join([" ;" if line == ";" else line for line in lines]) + "\n"
+
+def lazy_text(txt, funcs):
+	"""
+	Text, [Function] -> Text with the placeholders, {placeholder: Function}
+
+	The funcs are sorted by the position. A placeholder keeps the newlines
+	of the body so the line numbers of the following code don't change.
+	"""
+	chunks = []
+	placeholders = {}
+	pos = 0
+	for i, func in enumerate(funcs):
+		name = PLACEHOLDER % i
+		placeholders[name] = func
+		chunks.append(txt[pos:func.begin])
+		chunks.append("{%s;%s}" % (name, "\n" * txt.count("\n", func.begin, func.end)))
+		pos = func.end
+	chunks.append(txt[pos:])
+	return ("".join(chunks), placeholders)
+
+def opaque_funcs(funcs):
+	"""
+	[Function] -> [Function] whose bodies need not be parsed
+
+	None if a macroizable function can't be named because
+	then any body can mention it.
+	"""
+	names = set()
+	for func in funcs:
+		if func.isCandidate():
+			name = func.name()
+			if name is None:
+				return None
+			names.add(name)
+	result = []
+	for func in funcs:
+		if func.isCandidate():
+			continue
+		if names.isdisjoint(WORD.findall(func.body)):
+			result.append(func)
+	return result
+
+class Unlazy(ext_pycparser.NodeVisitor):
+	"""
+	Replace the placeholder bodies with the original texts
+	"""
+	def __init__(self, placeholders):
+		self.placeholders = placeholders
+		self.count = 0
+
+	def visit_FuncDef(self, n):
+		items = n.body.block_items or []
+		if len(items) != 1 or not isinstance(items[0], c_ast.ID):
+			return
+		func = self.placeholders.get(items[0].name)
+		if func is None:
+			return
+		n.body = ext_pycparser.Any(opaque_text(func.body), n.body.coord)
+		self.count += 1
+
+def ast_of(txt):
+	"""
+	Text -> AST
+
+	Same as ext_pycparser.ast_of but the bodies that can't mention any
+	macroizable function are Any nodes of their original text.
+	"""
+	with timing.t.phase("scan"):
+		opaques = opaque_funcs(scan(txt))
+	if not opaques:
+		return ext_pycparser.ast_of(txt)
+
+	lazy_txt, placeholders = lazy_text(txt, opaques)
+	ast = ext_pycparser.ast_of(lazy_txt)
+	unlazy = Unlazy(placeholders)
+	unlazy.visit(ast)
+	assert(unlazy.count == len(opaques))
+	return ast
+
+if __name__ == "__main__":
+	txt = r"""
+# 1 "a.c"
+struct S { int a; int (*f)(int); } s = { 1, 0 };
+int x = (1);
+static inline int f(int a) { return a + 1; }
+int g(int a) { return f(a); }
+int h(int a)
+{
+# 3 "a.c"
+	char *s = "}{ (";
+	if (a) {
+		return '}';
+	}
+;
+	return a;
+}
+static int (*k(void))(int) { return 0; }
+void l(void) { k(); }
+"""
+	funcs = scan(txt)
+	assert([func.name() for func in funcs] == ["f", "g", "h", "k", "l"])
+	assert([func.isCandidate() for func in funcs] == [True, False, False, True, False])
+	assert([func.name() for func in opaque_funcs(funcs)] == ["h"])
+
+	ast = ast_of(txt)
+	output = ext_pycparser.CGenerator().visit(ast)
+	assert("{ return f(a); }" not in output) # Parsed
+	assert('char *s = "}{ (";' in output) # Not parsed
+	assert("# 3" not in output)
+	assert("\n ;\n" in output)
+	assert(ext_pycparser.ast_of(output))
+
+	# A macroizable function without a name in sight
+	assert(opaque_funcs(scan("static int (f)(void) { return 0; }\nint g(void) { return 0; }\n")) is None)
@@ -0,0 +1,41 @@
+import multiprocessing
+
+import cfg
+
+# The job of the current map().
+# Workers are forked after these are set, so they inherit the job,
+# its inputs and the whole state of the process (the AST and rewrite.t).
+# Only the indices go to the workers and only the results come back.
+_job = None
+_items = None
+
+def _run(i):
+	return _job(_items[i])
+
+def enabled(n):
+	return cfg.t.jobs > 1 and n > 1 and not cfg.t.record_enabled
+
+def map(f, xs):
+	"""
+	[x] -> [f(x)]
+
+	f must not depend on the side effects of f on the other elements.
+	The results are pickled back from the workers,
+	so f should return only what has changed.
+	"""
+	if not enabled(len(xs)):
+		return [f(x) for x in xs]
+
+	global _job, _items
+	_job, _items = f, xs
+	pool = multiprocessing.Pool(min(cfg.t.jobs, len(xs)))
+	try:
+		results = pool.map(_run, range(len(xs)))
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+		_job, _items = None, None
+	return results
@@ -6,9 +6,16 @@ import StringIO
 import time
 
 class Recorder:
+	"""
+	Records the tracks of code translation into cfg.t.record_dir.
 
+	The contents can be given as a function that returns the text.
+	Nothing is generated, nor is the directory touched, unless recording is enabled.
+	The directory is cleared before the first record is written.
+	"""
 	def __init__(self):
 		self.rec_dir = cfg.t.record_dir
+		self.ready = False
 		self.file_rewrite_level = 0
 
 		self.current_fun_name = None
@@ -16,6 +23,11 @@ class Recorder:
 
 		self.last_time = time.clock()
 
+	def setup(self):
+		if self.ready:
+			return
+		self.ready = True
+
 		if os.path.exists(self.rec_dir):
 			shutil.rmtree(self.rec_dir)
 
@@ -29,9 +41,16 @@ class Recorder:
 		return str(ela * 1000) + "[ms]"
 
 	def file_record(self, title, contents):
+		"""
+		contents :: Text or () -> Text
+		"""
 		if not cfg.t.record_enabled:
 			return
 
+		self.setup()
+		if callable(contents):
+			contents = contents()
+
 		self.file_rewrite_level += 1
 		fn = "%s/%d-%s.c" % (self.rec_dir, self.file_rewrite_level, title)
 		f = open(fn, "w")
@@ -42,7 +61,8 @@ class Recorder:
 		if not cfg.t.record_enabled:
 			return
 
-		if not isinstance(ast, ext_pycparser.Any):
+		self.setup()
+		if not isinstance(ast, (ext_pycparser.Any, ext_pycparser.Macro)):
 			self.current_fun_name = ast.decl.name
 
 		fun_name = self.current_fun_name
@@ -66,3 +86,10 @@ class Recorder:
 		f.close()
 
 t = Recorder()
+
+def reset():
+	"""
+	Start recording another file with the current cfg.t
+	"""
+	global t
+	t = Recorder()
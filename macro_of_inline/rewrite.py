@@ -1,16 +1,23 @@
 from pycparser import c_ast
 
+import cache
+import callprofile
 import cfg
+import collections
 import copy
 import compound
 import cppwrap
 import ext_pycparser
+import lazy
 import os
 import pycparser
+import re
 import recorder
 import rewrite_void
 import rewrite_non_void
+import StringIO
 import sys
+import timing
 import utils
 
 class FuncDef(ext_pycparser.FuncDef):
@@ -26,30 +33,12 @@ class FuncDef(ext_pycparser.FuncDef):
 			return 4
 		return 0
 
-	class IsRecursive(c_ast.NodeVisitor, compound.SymbolTableMixin):
-		def __init__(self, func):
-			compound.SymbolTableMixin.__init__(self, func, set())
-			self.result = False
-
-		def visit_Decl(self, n):
-			self.register(n)
-
-		def visit_Compound(self, n):
-			self.switch()
-			c_ast.NodeVisitor.generic_visit(self, n)
-			self.revert()
-
-		def visit_FuncCall(self, n):
-			if self.result:
-				return
-
-			funcName = FuncDef(self.func).name()
-			callName = FuncCallName(n)
-			if (not callName in self.currentSymbols()) and (callName == funcName):
-				self.result = True
-
 	def isRecursive(self):
-		return ext_pycparser.Result(self.IsRecursive(self.func)).visit(self.func)
+		name = self.name()
+		for site in t.calls.of(self.func):
+			if site.name == name and not site.shadowed:
+				return True
+		return False
 
 	def doMacroize(self):
 		if self.hasVarArgs():
@@ -73,7 +62,7 @@ def FuncCallName(n):
 	but in pratice it is useless because most of the function calls are
 	in basic pattern (use the name as it defines).
 
-	We give random BLACKNAME that doesn't appear as function name
+	We give BLACKNAME that can't be a function name
 	to exclude the complex call patterns.
 	"""
 	if isinstance(n.name, c_ast.ID):
@@ -81,29 +70,358 @@ def FuncCallName(n):
 	else:
 		return BLACKNAME
 
+CallSite = collections.namedtuple('CallSite', 'name, call, cond, shadowed')
+"""
+name     : FuncCallName of the call
+call     : FuncCall
+cond     : the call is in the head of if, switch, for, while or do-while
+shadowed : the name is declared locally at the call
+"""
+
+class IndexCalls(c_ast.NodeVisitor):
+	"""
+	FuncDef or other top-level node -> [CallSite]
+
+	The number of the nodes visited is counted as the size.
+	"""
+	def __init__(self, n):
+		self.scopes = compound.SymbolTable()
+		if isinstance(n, c_ast.FuncDef):
+			self.scopes.register_args(n)
+		self.cond = False
+		self.size = 0
+		self.result = []
+
+	def visit(self, n):
+		self.size += 1
+		c_ast.NodeVisitor.visit(self, n)
+
+	def visit_FuncDef(self, n):
+		# The function's own name is not a local name.
+		self.visit(n.body)
+
+	def visit_Compound(self, n):
+		self.scopes.push()
+		for item in n.block_items or []:
+			self.visit(item)
+		self.scopes.pop()
+
+	def visit_Decl(self, n):
+		self.scopes.register(n.name)
+		c_ast.NodeVisitor.generic_visit(self, n)
+
+	def visit_Struct(self, n):
+		pass
+
+	def visit_Union(self, n):
+		pass
+
+	def visitCond(self, *ns):
+		cond, self.cond = self.cond, True
+		for n in ns:
+			if n:
+				self.visit(n)
+		self.cond = cond
+
+	def visit_If(self, n):
+		self.visitCond(n.cond)
+		self.visit(n.iftrue)
+		if n.iffalse:
+			self.visit(n.iffalse)
+
+	def visit_Switch(self, n):
+		self.visitCond(n.cond)
+		self.visit(n.stmt)
+
+	def visit_Case(self, n):
+		self.visitCond(n.expr)
+		for stmt in n.stmts or []:
+			self.visit(stmt)
+
+	def visit_For(self, n):
+		self.visitCond(n.init, n.cond, n.next)
+		self.visit(n.stmt)
+
+	def visit_While(self, n):
+		self.visitCond(n.cond)
+		self.visit(n.stmt)
+
+	def visit_DoWhile(self, n):
+		self.visit(n.stmt)
+		self.visitCond(n.cond)
+
+	def visit_FuncCall(self, n):
+		name = FuncCallName(n)
+		self.result.append(CallSite(name, n, self.cond, name in self.scopes))
+		c_ast.NodeVisitor.generic_visit(self, n)
+
+class CallSites:
+	"""
+	Index of all the function calls in a translation unit.
+
+	A top-level node is walked once when it is first queried.
+	A rewritten function must be forgotten to be walked again.
+	"""
+	def __init__(self):
+		self.sites = {} # id(node) -> (node, [CallSite], size)
+
+	def index(self, n):
+		k = id(n)
+		if not k in self.sites:
+			visitor = IndexCalls(n)
+			visitor.visit(n)
+			self.sites[k] = (n, visitor.result, visitor.size)
+		return self.sites[k]
+
+	def of(self, n):
+		"""
+		Top-level node -> [CallSite]
+		"""
+		return self.index(n)[1]
+
+	def sizeOf(self, n):
+		"""
+		Top-level node -> number of the AST nodes
+		"""
+		return self.index(n)[2]
+
+	def forget(self, n):
+		self.sites.pop(id(n), None)
+
+class CostModel:
+	"""
+	Decide the call sites where the macros are expanded.
+
+	The size of a function is the number of its AST nodes and
+	expanding a macro adds the expanded size of the callee to the caller.
+	A call site is expanded only if the nesting of the macros stays within
+	cfg.t.max_inline_depth and the growth of the caller within
+	cfg.t.max_inline_growth. Otherwise it is left as a plain call.
+
+	Callees are decided before their callers.
+	A call back to a function being decided (mutual recursion) is left as a plain call.
+	"""
+	def __init__(self, context, macroizables):
+		self.context = context
+		self.macroizables = macroizables
+		self.deciding = set() # name
+		self.depth = {} # name -> nesting of the macros expanded in the function
+		self.size = {} # name -> expanded size
+		self.result = set() # FuncCall
+
+	def decide(self, name):
+		if name in self.size or name in self.deciding:
+			return
+		self.deciding.add(name)
+
+		_, func = self.context.all_funcs[name]
+		depth = 0
+		growth = 0
+		for site in self.context.calls.of(func):
+			callee = site.name
+			if not callee in self.macroizables or site.shadowed or site.cond:
+				continue
+			if not self.context.isHot(name, callee):
+				continue
+			self.decide(callee)
+			if callee in self.deciding:
+				continue
+			if self.depth[callee] + 1 > cfg.t.max_inline_depth:
+				continue
+			if growth + self.size[callee] > cfg.t.max_inline_growth:
+				continue
+			self.result.add(site.call)
+			depth = max(depth, self.depth[callee] + 1)
+			growth += self.size[callee]
+
+		self.deciding.remove(name)
+		self.depth[name] = depth
+		self.size[name] = self.context.calls.sizeOf(func) + growth
+
+	def run(self):
+		for name, _ in sorted(self.context.all_funcs.items(), key=lambda x: x[1][0]):
+			if not self.context.isFixed(name):
+				self.decide(name)
+		return self
+
 class Context:
 	def __init__(self):
-		self.rand_names = set()
+		self.prefix = "m"
+		self.func_ids = {} # name -> int
+		self.counters = {} # (kind, name) -> int
 
 		self.all_funcs = {} # name -> (i, ast)
 		self.macroizables = set() # set(name)
 		self.typedefs = {} # name -> ast
+		self.calls = CallSites()
+		self.profile = None
+		self.origins = {} # generated function name -> original name
+		self.main_file = None # None if the headers are not told apart
+		self.included = set() # names of the functions defined in the headers
+
+	def isIncluded(self, n):
+		"""
+		Top-level node -> bool
+
+		The node comes from a header, which is never rewritten nor emitted.
+		The functions generated from the functions of the headers
+		(e.g. void_f) are not included.
+		"""
+		if not self.main_file or not n.coord or not n.coord.file:
+			return False
+		if isinstance(n, c_ast.FuncDef):
+			n = n.decl
+		if getattr(n, "name", None) in self.origins:
+			return False
+		return os.path.abspath(n.coord.file) != self.main_file
+
+	def isFixed(self, name):
+		"""
+		The function of a header that is not macroizable.
+		Its calls are never rewritten.
+		"""
+		return name in self.included and not name in self.macroizables
+
+	def choosePrefix(self, ast):
+		"""
+		The prefix of the generated names that no name in the AST can be confused with
+		"""
+		names = ext_pycparser.Result(ext_pycparser.AllIdentifiers()).visit(ast)
+		prefix = "m"
+		while True:
+			r = re.compile(r"^%s[a-z]\d+(_\d+)?$" % prefix)
+			if not any(r.match(name) for name in names):
+				return prefix
+			prefix += "m"
+
+	def newName(self, kind, scope):
+		"""
+		kind (letter) -> function name (or None) -> identifier
+
+		$prefix$kind$function_id_$counter (e.g. mv3_0)
+
+		Each kind of names in a function is generated in one pass
+		(so in one process even with -j) thus the names are
+		the same for the same input.
+		"""
+		k = (kind, scope)
+		n = self.counters.get(k, 0)
+		self.counters[k] = n + 1
+		if scope is None:
+			return "%s%s%d" % (self.prefix, kind, n)
+		if not scope in self.func_ids:
+			self.func_ids[scope] = len(self.func_ids)
+		return "%s%s%d_%d" % (self.prefix, kind, self.func_ids[scope], n)
+
+	def replaceFunc(self, ast, i, func):
+		"""
+		Put back a function rewritten as another object (e.g. by another process)
+		"""
+		self.calls.forget(ast.ext[i])
+		self.calls.forget(func)
+		ast.ext[i] = func
+		self.all_funcs[FuncDef(func).name()] = (i, func)
 
 	def blacklist(self, ast):
-		f = lambda n: FuncCallName(n)
-		all_calls = utils.countMap(map(f, ext_pycparser.Result(ext_pycparser.AllFuncCalls()).visit(ast)))
-		# print all_calls
-		incomp_calls = utils.countMap(map(f, ext_pycparser.Result(compound.AllFuncCalls()).visit(ast)))
-		# print incomp_calls
-		utils.countMapDiff(all_calls, incomp_calls)
-		return set([k for k, v in all_calls.items() if v > 0])
+		"""
+		Functions called in the heads of the control statements
+		"""
+		result = set()
+		for n in ast.ext:
+			for site in self.calls.of(n):
+				if site.cond:
+					result.add(site.name)
+		return result
+
+	def expandedCalls(self, macroizables):
+		"""
+		set(name) -> set(FuncCall)
+
+		The calls to the macroizables that are worth expanding
+		"""
+		return CostModel(self, macroizables).run().result
+
+	def expandedMacros(self, macroizables, expanded):
+		"""
+		set(name) -> set(FuncCall) -> set(name)
+
+		The macroizables whose macros are expanded at any of the calls,
+		in a function or in a macro that is expanded in turn.
+		The calls in the other macroizables don't count
+		because their definitions are put back as they were.
+		"""
+		result = set()
+		def visit(func):
+			for site in self.calls.of(func):
+				if site.call in expanded and not site.name in result:
+					result.add(site.name)
+					visit(self.all_funcs[site.name][1])
+		for name, (_, func) in self.all_funcs.items():
+			if not name in macroizables and not self.isFixed(name):
+				visit(func)
+		return result
+
+	def isHot(self, caller, callee):
+		"""
+		Without profile all the calls are hot
+		"""
+		if not self.profile:
+			return True
+		return self.profile.isHot(self.origins.get(caller, caller), self.origins.get(callee, callee))
+
+	def hotCallees(self, func, names):
+		"""
+		FuncDef -> set(name) -> set(name)
+
+		The names that are hot when called from the function
+		"""
+		caller = FuncDef(func).name()
+		return set([name for name in names if self.isHot(caller, name)])
+
+	def hotOnly(self, names):
+		"""
+		set(name) -> set(name)
+
+		The names called at least once at a hot call site
+		"""
+		result = set()
+		for caller, (_, func) in self.all_funcs.items():
+			if self.isFixed(caller):
+				continue
+			for site in self.calls.of(func):
+				if site.name in names and self.isHot(caller, site.name):
+					result.add(site.name)
+		return result
+
+	def callers(self, names):
+		"""
+		names -> [(i, FuncDef)]
+
+		Only the functions that call any of the names
+		"""
+		result = []
+		for name, (i, func) in self.all_funcs.items():
+			if self.isFixed(name):
+				continue
+			for site in self.calls.of(func):
+				if site.name in names:
+					result.append((i, func))
+					break
+		return result
 
 	def setupAST(self, ast):
 		compound.Brace().visit(ast) # The statements always be surrounded by { and }
 
+		if not self.func_ids:
+			self.prefix = self.choosePrefix(ast)
+
 		for i, n in enumerate(ast.ext):
 			if isinstance(n, c_ast.FuncDef):
 				self.all_funcs[FuncDef(n).name()] = (i, n)
+				if self.isIncluded(n):
+					self.included.add(FuncDef(n).name())
+				if not FuncDef(n).name() in self.func_ids:
+					self.func_ids[FuncDef(n).name()] = len(self.func_ids)
 			if isinstance(n, c_ast.Typedef):
 				self.typedefs[n.name] = n
 
@@ -117,11 +435,32 @@ class Context:
 		# print blacklist
 		self.macroizables -= blacklist
 
+		# Cold functions are not worth macroizing
+		if cfg.t.call_profile:
+			self.profile = callprofile.load(cfg.t.call_profile, cfg.t.hot_threshold)
+			self.macroizables = self.hotOnly(self.macroizables)
+
 t = Context()
 
-def newrandstr():
-	return utils.newrandstr(t.rand_names, utils.N)
-BLACKNAME = newrandstr()
+# Kinds of the generated names
+LOCAL_VAR = "v" # renamed local variable of a macroized function
+ARG = "a" # argument copied to a local variable
+RETVAL = "r" # variable to receive the return value
+NAMESPACE = "n" # namespace of a macro call
+LABEL = "l" # normalized label
+
+def newName(kind, scope):
+	return t.newName(kind, scope)
+
+BLACKNAME = "<complex call>"
+
+def reset():
+	"""
+	Forget the translation unit processed before.
+	Call this before processing another file in the same process.
+	"""
+	global t
+	t = Context()
 
 MACROIZE_NON_VOID = True
 class AST:
@@ -134,52 +473,100 @@ class AST:
 
 	def run(self):
 		if MACROIZE_NON_VOID:
-			runner = rewrite_non_void.Main(self.ast)
+			with timing.t.phase("rewrite_non_void"):
+				with timing.t.phase("setup_ast"):
+					runner = rewrite_non_void.Main(self.ast)
+				runner.run()
+				self.ast = runner.returnAST()
+			recorder.t.file_record("convert_non_void_to_void", lambda: ext_pycparser.CGenerator().visit(self.ast))
+
+		with timing.t.phase("rewrite_void"):
+			with timing.t.phase("setup_ast"):
+				runner = rewrite_void.Main(self.ast)
 			runner.run()
 			self.ast = runner.returnAST()
-			recorder.t.file_record("convert_non_void_to_void", ext_pycparser.CGenerator().visit(self.ast))
-
-		runner = rewrite_void.Main(self.ast)
-		runner.run()
-		self.ast = runner.returnAST()
 		return self
 
 	def returnAST(self):
 		return self.ast
 
+fake_include_asts = {} # (path, mtime, size) -> AST
+
+def fake_include_ast(filename):
+	"""
+	File -> AST
+
+	The fake include is the same for all the files of a project.
+	It is parsed once in a process, and with --cache once for all processes.
+	The AST is shared thus must not be modified.
+	"""
+	st = os.stat(filename)
+	memo_key = (os.path.abspath(filename), st.st_mtime, st.st_size)
+	if memo_key in fake_include_asts:
+		return fake_include_asts[memo_key]
+
+	with open(filename) as fp:
+		txt = fp.read()
+
+	ast = None
+	if cfg.t.cache_enabled:
+		dc = cache.DiskCache(os.path.join(cfg.t.cache_dir, "fake_include"), cfg.t.cache_size)
+		key = cache.key_of(txt, repr(st.st_mtime))
+		ast = dc.get(key)
+
+	if not ast:
+		ast = ext_pycparser.ast_of(txt)
+		if cfg.t.cache_enabled:
+			dc.put(key, ast)
+			dc.evict()
+
+	fake_include_asts[memo_key] = ast
+	return ast
+
 class Wrap:
 	"""
 	Text -> AST
+
+	With the filename of the main file, the nodes of the headers
+	(according to the line markers) are left as they are and dropped
+	from the AST returned.
 	"""
-	def __init__(self, txt):
+	def __init__(self, txt, filename=None):
 		self.txt = txt
+		self.filename = filename
 
 	def run(self):
 		fake_include = cfg.t.fake_include
 
 		if fake_include:
-			fn = "/tmp/%s.c" % utils.randstr(16)
-			with open(fn, "w") as fp:
-				fp.write(self.txt)
-
-			# TODO Ugly. Loan pattern
 			try:
-				cpp_args = ['-E', r'-include%s' % fake_include]
-				cpped_txt = utils.preprocess_file(fn, cpp_path='gcc', cpp_args=cpp_args)
+				with timing.t.phase("fake_include"):
+					cpp_args = ['-E', r'-include%s' % fake_include, '-x', 'c']
+					cpped_txt = utils.preprocess_text(self.txt, cpp_path='gcc', cpp_args=cpp_args)
 			except Exception as e:
 				sys.stderr.write(e.message)
 				sys.exit(1)
-			finally:
-				os.remove(fn)
 		else:
 			cpped_txt = self.txt
 
-		ast = AST(ext_pycparser.ast_of(cpped_txt)).run().returnAST()
-
-		if fake_include:
-			with open(fake_include) as fp:
-				ast_b = ext_pycparser.ast_of(fp.read())
-			cppwrap.ast_delete(ast, ast_b)
+		with timing.t.phase("parse"):
+			if cfg.t.lazy:
+				ast = lazy.ast_of(cpped_txt)
+			else:
+				ast = ext_pycparser.ast_of(cpped_txt)
+		if self.filename:
+			t.main_file = os.path.abspath(self.filename)
+		with timing.t.phase("setup_ast"):
+			runner = AST(ast)
+		ast = runner.run().returnAST()
+
+		if self.filename:
+			# The fake include is one of the headers
+			with timing.t.phase("delete_included"):
+				ast.ext = [n for n in ast.ext if not t.isIncluded(n)]
+		elif fake_include:
+			with timing.t.phase("delete_fake_include"):
+				cppwrap.ast_delete(ast, fake_include_ast(fake_include))
 
 		return ast
 
@@ -190,23 +577,113 @@ class Main:
 	def __init__(self, filename):
 		self.filename = filename
 
-	def run(self):
-		f = lambda text: Wrap(text).run() # Text -> AST
+	def preprocess(self):
+		"""
+		File -> Text
+		"""
 		if cfg.t.with_cpp:
 			if cfg.t.cpp_mode == 'gcc':
-				cpped_txt = utils.cpp(self.filename)
-				output = ext_pycparser.CGenerator().visit(f(cpped_txt))
+				return utils.cpp(self.filename)
 			else:
-				output = cppwrap.Apply(f).on(self.filename)
+				return cppwrap.cpp(self.filename)
 		else:
 			with open(self.filename, "r") as fp:
-				cpped_txt = fp.read()
-			try:
-				output = ext_pycparser.CGenerator().visit(f(cpped_txt))
-			except:
-				sys.stderr.write("[ERROR] %s failed to parse. Is this file preprocessed? Do you forget --with-cpp?\n" % self.filename)
+				return fp.read()
+
+	def transform(self, cpped_txt, fp):
+		"""
+		Text -> fp
+
+		The output is generated and cleaned up one top-level node at a time
+		so the whole text is never built in memory.
+		"""
+		out = ext_pycparser.CleanUp(fp)
+		def emit(ast):
+			with timing.t.phase("generate"):
+				ext_pycparser.CGenerator().emit(ast, out)
+		if cfg.t.with_cpp:
+			if cfg.t.cpp_mode == 'gcc':
+				emit(Wrap(cpped_txt).run())
+			else:
+				f = lambda text: Wrap(text, self.filename).run() # Text -> AST
+				cppwrap.Apply(f).emitText(self.filename, cpped_txt, out)
+		else:
+			emit(Wrap(cpped_txt).run())
+		out.close()
+
+	def options(self):
+		"""
+		Everything other than the input files that affects the output
+		"""
+		fake_include = cfg.t.fake_include
+		if fake_include:
+			fake_include = (os.path.abspath(fake_include), cache.file_digest(fake_include))
+		call_profile = cfg.t.call_profile
+		if call_profile:
+			call_profile = (cache.file_digest(call_profile), cfg.t.hot_threshold)
+		return repr((os.path.abspath(self.filename), cfg.t.with_cpp, cfg.t.cpp_mode,
+			cfg.t.extra_options, str(cfg.t.inline_mask), fake_include,
+			cfg.t.max_inline_depth, cfg.t.max_inline_growth, call_profile, cfg.t.lazy))
+
+	def runCached(self):
+		oc = cache.OutputCache(os.path.join(cfg.t.cache_dir, "output"), cfg.t.cache_size, self.options())
+		with open(self.filename, "r") as fp:
+			src_txt = fp.read()
+
+		with timing.t.phase("cache_lookup"):
+			result = oc.lookup(src_txt)
+		if result:
+			status, output = result
+			if status == "error":
+				sys.stderr.write("[ERROR] %s failed to parse in the previous run (cached)\n" % self.filename)
 				sys.exit(1)
-		return ext_pycparser.CGenerator.cleanUp(output)
+			return output
+
+		with timing.t.phase("preprocess"):
+			cpped_txt = self.preprocess()
+		# Take the digests before transforming
+		# so that headers modified meanwhile make the next lookup miss.
+		manifest = oc.manifestOf(cppwrap.include_closure(cpped_txt) | set([os.path.abspath(self.filename)]))
+		try:
+			with timing.t.phase("transform"):
+				fp = StringIO.StringIO()
+				self.transform(cpped_txt, fp)
+				output = fp.getvalue()
+		except pycparser.plyparser.ParseError:
+			# Only the input is to blame. The other failures
+			# (e.g. a bug fixed later) are not cached.
+			oc.save(src_txt, manifest, ("error", None))
+			raise
+		with timing.t.phase("cache_save"):
+			oc.save(src_txt, manifest, ("ok", output))
+		return output
+
+	def emit(self, fp):
+		"""
+		File -> fp
+		"""
+		timing.reset(self.filename)
+		try:
+			if cfg.t.cache_enabled:
+				fp.write(self.runCached())
+				return
+			with timing.t.phase("preprocess"):
+				cpped_txt = self.preprocess()
+			with timing.t.phase("transform"):
+				self.transform(cpped_txt, fp)
+		except pycparser.plyparser.ParseError:
+			if cfg.t.with_cpp:
+				raise
+			sys.stderr.write("[ERROR] %s failed to parse. Is this file preprocessed? Do you forget --with-cpp?\n" % self.filename)
+			sys.exit(1)
+
+	def run(self):
+		"""
+		File -> Text
+		"""
+		fp = StringIO.StringIO()
+		self.emit(fp)
+		return fp.getvalue()
 
 if __name__ == "__main__":
 	fn = "/tmp/%s.c" % utils.randstr(16)
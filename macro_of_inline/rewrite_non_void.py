@@ -2,20 +2,21 @@ from pycparser import c_ast, c_generator
 
 import cfg
 import compound
-import copy
 import ext_pycparser
 import inspect
+import parallel
 import recorder
 import rewrite
 import rewrite_void_fun
 import rewrite_non_void_fun
+import timing
 import utils
 
 def mkDecl(func, newname):
 	"""
 	int f(...) {}, name -> int name;
 	"""
-	decl = copy.deepcopy(func.decl.type.type)
+	decl = ext_pycparser.clone_declarator(func.decl.type.type)
 	ext_pycparser.RewriteTypeDecl(newname).visit(decl)
 	return c_ast.Decl(newname, [], [], [], decl, None, None)
 
@@ -34,6 +35,7 @@ class RewriteCaller:
 		self.func = func
 		self.phase_no = 0
 		self.macroizables = macroizables
+		self.changed = False
 
 	class AssignRetVal(compound.NodeVisitor, compound.SymbolTableMixin):
 		"""
@@ -43,6 +45,7 @@ class RewriteCaller:
 		"""
 		def __init__(self, func, macroizables):
 			compound.SymbolTableMixin.__init__(self, func, macroizables)
+			self.result = False # rewritten
 
 		def visit_Compound(self, n):
 			if not n.block_items:
@@ -56,11 +59,11 @@ class RewriteCaller:
 				if not self.canMacroize(rewrite.FuncCallName(call)):
 					return
 
-				randvar = rewrite.newrandstr()
-				n.block_items[i] = c_ast.Assignment("=", c_ast.ID(randvar), call)
+				retvar = rewrite.newName(rewrite.RETVAL, self.func.decl.name)
+				n.block_items[i] = c_ast.Assignment("=", c_ast.ID(retvar), call)
 
 				_, func = rewrite.t.all_funcs[rewrite.FuncCallName(call)]
-				insert_list.append((0, mkDecl(func, randvar)))
+				insert_list.append((0, mkDecl(func, retvar)))
 
 			for i, item in enumerate(n.block_items):
 				if isinstance(item, c_ast.Decl):
@@ -80,41 +83,96 @@ class RewriteCaller:
 
 					name = rewrite.FuncCallName(item.expr)
 
-					randvar = rewrite.newrandstr()
-					insert_list.append((i, c_ast.Assignment("=", c_ast.ID(randvar), item.expr)))
-					item.expr = c_ast.ID(randvar)
+					retvar = rewrite.newName(rewrite.RETVAL, self.func.decl.name)
+					insert_list.append((i, c_ast.Assignment("=", c_ast.ID(retvar), item.expr)))
+					item.expr = c_ast.ID(retvar)
 
 					_, func = rewrite.t.all_funcs[name]
-					insert_list.append((0, mkDecl(func, randvar)))
+					insert_list.append((0, mkDecl(func, retvar)))
 
 			compound.NodeVisitor.generic_visit(self, n)
 
-			insert_list.sort(key=lambda x: -x[0])
-			for i, m in insert_list:
-				n.block_items.insert(i, m)
+			# The later planned comes first at the same position.
+			splice = ext_pycparser.Splice(n.block_items)
+			for i, m in reversed(insert_list):
+				splice.insert(i, m)
+			splice.apply()
+			if insert_list:
+				self.result = True
 
 			self.revert()
 
 	class PopNested(compound.NodeVisitor, compound.SymbolTableMixin):
 		"""
 		r = f(g()) -> U u; u = g(); r = f(u);
+
+		Every compound is flattened in a single pass.
+		The assignment popped out is itself flattened by a worklist
+		so a chain of nested calls never restarts the whole function.
 		"""
 		def __init__(self, func, macroizables):
 			compound.SymbolTableMixin.__init__(self, func, macroizables)
 			self.result = False # found
-			self.insert_list = [] # [(i, AST)]
-			self.nestedCall = []
+			self.popped = None # [(Assignment, Decl)] being collected
+
+		def pop(self, assign):
+			"""
+			Assignment -> [(Assignment, Decl)]
+
+			Replace the outermost macroizable calls
+			in the arguments of the assignment with new variables.
+			The assignments to the variables are returned in the found order
+			along with the declarations of the variables.
+			"""
+			self.popped = []
+			compound.NodeVisitor.generic_visit(self, assign.rvalue)
+			popped, self.popped = self.popped, None
+			return popped
+
+		def flatten(self, assign, levels):
+			"""
+			Assignment -> [stmt]
+
+			The statements replacing the assignment.
+			levels[k] collects the retval declarations found at the depth k.
+			"""
+			children = {}
+			frontier = [assign]
+			k = 0
+			while frontier:
+				if len(levels) == k:
+					levels.append([])
+				nexts = []
+				for m in frontier:
+					popped = self.pop(m)
+					children[id(m)] = [a for a, _ in popped]
+					levels[k].extend([decl for _, decl in popped])
+					# The last popped is placed first
+					nexts.extend(reversed(children[id(m)]))
+				frontier = nexts
+				k += 1
+
+			stmts = []
+			stack = [(assign, False)]
+			while stack:
+				m, done = stack.pop()
+				if done:
+					stmts.append(m)
+					continue
+				stack.append((m, True))
+				for a in children[id(m)]:
+					stack.append((a, False))
+			return stmts
 
 		def visit_Compound(self, n):
-			if self.result:
-				return
-
 			if not n.block_items:
 				return
 
 			self.switch()
 
-			for i, item in enumerate(n.block_items):
+			levels = [] # [[Decl]]
+			block_items = []
+			for item in n.block_items:
 				# We ignore Decls because inserting assignment (retval = g())
 				# before some variable declartion is rejected by compiler as
 				# mixed declaration (ISO C90).
@@ -123,25 +181,24 @@ class RewriteCaller:
 				if isinstance(item, c_ast.Decl):
 					self.register(item)
 
-				if not isinstance(item, c_ast.Assignment):
-					continue
-
-				call = item.rvalue
-				if not isinstance(call, c_ast.FuncCall):
+				if not isinstance(item, c_ast.Assignment) or \
+				   not isinstance(item.rvalue, c_ast.FuncCall):
+					block_items.append(item)
 					continue
 
-				self.nestedCall = [i]
-				compound.NodeVisitor.generic_visit(self, call)
-				self.nestedCall = []
+				block_items.extend(self.flatten(item, levels))
 
-			for i, m in sorted(self.insert_list, key=lambda x: -x[0]):
-				n.block_items.insert(i, m)
+			decls = [decl for level in levels for decl in level]
+			if decls:
+				decls.reverse()
+				n.block_items = decls + block_items
+				self.result = True
 
 			compound.NodeVisitor.generic_visit(self, n)
 			self.revert()
 
 		def visit_FuncCall(self, n):
-			if not self.nestedCall:
+			if self.popped is None:
 				return
 
 			name = rewrite.FuncCallName(n)
@@ -149,17 +206,12 @@ class RewriteCaller:
 				compound.NodeVisitor.generic_visit(self, n)
 				return
 
-			randvar = rewrite.newrandstr()
+			retvar = rewrite.newName(rewrite.RETVAL, self.func.decl.name)
 
-			ext_pycparser.NodeVisitor.rewrite(self.current_parent, self.current_name, c_ast.ID(randvar))
+			ext_pycparser.NodeVisitor.rewrite(self.current_parent, self.current_name, c_ast.ID(retvar))
 			_, func = rewrite.t.all_funcs[name]
 
-			# Order of these two lines is important.
-			# nestedCall[0] can be 0. function call must be placed after declaring retval.
-			self.insert_list.append((self.nestedCall[0], c_ast.Assignment("=", c_ast.ID(randvar), n)))
-			self.insert_list.append((0, mkDecl(func, randvar)))
-
-			self.result = True
+			self.popped.append((c_ast.Assignment("=", c_ast.ID(retvar), n), mkDecl(func, retvar)))
 
 	class ToVoid(compound.NodeVisitor, compound.SymbolTableMixin):
 		"""
@@ -167,6 +219,7 @@ class RewriteCaller:
 		"""
 		def __init__(self, func, macroizables):
 			compound.SymbolTableMixin.__init__(self, func, macroizables)
+			self.result = False # rewritten
 
 		def visit_Compound(self, n):
 			if not n.block_items:
@@ -190,21 +243,24 @@ class RewriteCaller:
 					call.args = c_ast.ExprList([])
 				call.args.exprs.insert(0, c_ast.UnaryOp("&", item.lvalue))
 				n.block_items[i] = call
+				self.result = True
 
 			compound.NodeVisitor.generic_visit(self, n)
 			self.revert()
 
 	def run(self):
-		self.AssignRetVal(self.func, self.macroizables).visit(self.func)
+		if ext_pycparser.Result(self.AssignRetVal(self.func, self.macroizables)).visit(self.func):
+			self.changed = True
 		self.phase_no += 1
 		recorder.t.fun_record("assign_retval", self.func)
 
-		while ext_pycparser.Result(self.PopNested(self.func, self.macroizables)).visit(self.func):
-			pass
+		if ext_pycparser.Result(self.PopNested(self.func, self.macroizables)).visit(self.func):
+			self.changed = True
 		self.phase_no += 1
 		recorder.t.fun_record("pop_nested", self.func)
 
-		self.ToVoid(self.func, self.macroizables).visit(self.func)
+		if ext_pycparser.Result(self.ToVoid(self.func, self.macroizables)).visit(self.func):
+			self.changed = True
 		self.phase_no += 1
 		recorder.t.fun_record("to_void", self.func)
 
@@ -226,19 +282,37 @@ class Main:
 		self.ast = ast
 
 	def rewriteCallers(self, macroizables):
-		for i, func in rewrite.t.all_funcs.values():
-			self.ast.ext[i] = RewriteCaller(func, macroizables).run().returnAST()
-		recorder.t.file_record("rewrite_all_callers", c_generator.CGenerator().visit(self.ast))
+		def rewriteCaller(func):
+			"""
+			Return the function only if rewritten
+			"""
+			# Cold call sites keep calling the non-void function.
+			runner = RewriteCaller(func, rewrite.t.hotCallees(func, macroizables)).run()
+			if not runner.changed:
+				return None
+			return runner.returnAST()
+
+		funcs = rewrite.t.callers(macroizables)
+		rewritten = parallel.map(rewriteCaller, [func for _, func in funcs])
+		for (i, _), func in zip(funcs, rewritten):
+			if func:
+				rewrite.t.replaceFunc(self.ast, i, func)
+		recorder.t.file_record("rewrite_all_callers", lambda: c_generator.CGenerator().visit(self.ast))
 
 	def rewriteDefs(self, macroizables):
-		void_funcs = []
+		def rewriteDef(func):
+			return rewrite_non_void_fun.Main(ext_pycparser.clone(func)).run().returnAST()
+
 		for name in macroizables:
-			i, func = rewrite.t.all_funcs[name]
-			void_funcs.append((i, rewrite_non_void_fun.Main(copy.deepcopy(func)).run().returnAST()))
+			rewrite.t.origins["void_%s" % name] = name
+
+		funcs = [rewrite.t.all_funcs[name] for name in macroizables]
+		void_funcs = zip([i for i, _ in funcs], parallel.map(rewriteDef, [func for _, func in funcs]))
 
-		void_funcs.sort(key=lambda x: -x[0]) # reverse order
+		splice = ext_pycparser.Splice(self.ast.ext)
 		for i, vfunc in void_funcs:
-			self.ast.ext.insert(i, vfunc)
+			splice.insert(i, vfunc)
+		splice.apply()
 
 		# FIXME
 		# I see no reason why we need to insert prototypes.
@@ -255,7 +329,7 @@ class Main:
 		# 		continue
 		# 	decl = copy.deepcopy(vfunc.decl)
 		# 	self.ast.ext.insert(declLocs[name], decl)
-		recorder.t.file_record("rewrite_func_defines", c_generator.CGenerator().visit(self.ast))
+		recorder.t.file_record("rewrite_func_defines", lambda: c_generator.CGenerator().visit(self.ast))
 
 	def run(self):
 		macroizables = set()
@@ -264,9 +338,11 @@ class Main:
 			if not ext_pycparser.FuncDef(func).returnVoid():
 				macroizables.add(name)
 
-		self.rewriteCallers(macroizables)
+		with timing.t.phase("rewrite_callers"):
+			self.rewriteCallers(macroizables)
 
-		self.rewriteDefs(macroizables)
+		with timing.t.phase("rewrite_defs"):
+			self.rewriteDefs(macroizables)
 
 		return self
 
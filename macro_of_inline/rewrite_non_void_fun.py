@@ -1,6 +1,5 @@
 from pycparser import c_ast
 
-import copy
 import ext_pycparser
 import recorder
 import rewrite
@@ -30,7 +29,7 @@ class Main(ext_pycparser.FuncDef):
 		self.func.decl.name = newname
 		ext_pycparser.RewriteTypeDecl(newname).visit(funtype.type)
 
-		rettype = copy.deepcopy(funtype.type)
+		rettype = ext_pycparser.clone_declarator(funtype.type)
 		ext_pycparser.RewriteTypeDecl("retval").visit(rettype)
 		newarg = c_ast.Decl("retval", [], [], [], c_ast.PtrDecl([], rettype), None, None)
 		params = []
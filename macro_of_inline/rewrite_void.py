@@ -4,21 +4,22 @@ import os
 
 import cfg
 import compound
-import copy
 import cppwrap
 import ext_pycparser
+import parallel
 import pycparser
 import recorder
 import rewrite
 import rewrite_void_fun
 import sys
+import timing
 import utils
 
 NORMALIZE_LABEL = True
 
 class RewriteCaller(compound.NodeVisitor, compound.SymbolTableMixin):
 	"""
-	Add random namespace macro calls.
+	Add namespace to macro calls.
 
 	To allow multiple returns in a function we need exit label
 	at the end of the definition.
@@ -43,10 +44,12 @@ class RewriteCaller(compound.NodeVisitor, compound.SymbolTableMixin):
 	f(rand_label_1);
 	f(rand_label_2); // won't conflict
 	"""
-	def __init__(self, func, macroizables):
+	def __init__(self, func, macroizables, expanded):
 		compound.SymbolTableMixin.__init__(self, func, macroizables)
+		self.expanded = expanded # set(FuncCall)
 		name = ext_pycparser.FuncDef(func).name()
 		self.called_in_macro = True if name in macroizables else False
+		self.result = False # rewritten
 
 	def visit_Compound(self, n):
 		self.switch()
@@ -62,11 +65,16 @@ class RewriteCaller(compound.NodeVisitor, compound.SymbolTableMixin):
 		if not self.canMacroize(name):
 			return
 
+		# Left as a plain call by the cost model
+		if not n in self.expanded:
+			return
+
 		# Assignment to n.name.name always work because we only consider
 		# basic function call f(...).
 		n.name.name = "macro_%s" % name # macro_f(...)
+		self.result = True
 
-		namespace = rewrite.newrandstr()
+		namespace = rewrite.newName(rewrite.NAMESPACE, self.func.decl.name)
 		if self.called_in_macro:
 			namespace = "namespace ## %s" % namespace
 
@@ -82,21 +90,103 @@ class Main:
 		rewrite.t.setupAST(ast)
 		self.ast = ast
 
-	def applyPreprocess(self):
-		fn = "/tmp/%s.c" % utils.randstr(16)
-		with open(fn, "w") as fp:
-			txt = ext_pycparser.CGenerator().visit(self.ast)
-			fp.write(ext_pycparser.CGenerator.cleanUp(txt))
+	class Substitute(ext_pycparser.NodeVisitor):
+		"""
+		Bind the arguments of a macro call to the copy of the macro body.
+		Parameters are replaced by the argument expressions and
+		"namespace ## x" is pasted into a single name.
+		"""
+		def __init__(self, namespace, args):
+			self.namespace = namespace
+			self.args = args # param -> expr
+
+		def paste(self, name):
+			prefix = "namespace ## "
+			if name.startswith(prefix):
+				return self.namespace + name[len(prefix):]
+			return name
+
+		def visit_ID(self, n):
+			if n.name in self.args:
+				ext_pycparser.NodeVisitor.rewrite(self.current_parent, self.current_name, ext_pycparser.clone(self.args[n.name]))
+				return
+			n.name = self.paste(n.name)
+
+		def visit_Goto(self, n):
+			n.name = self.paste(n.name)
+
+		def visit_Label(self, n):
+			n.name = self.paste(n.name)
+			ext_pycparser.NodeVisitor.generic_visit(self, n)
+
+	class ExpandMacros(ext_pycparser.NodeVisitor):
+		"""
+		Expand the macro calls in the AST as cpp would do.
+
+		macro_f(rand, a);
+
+		=>
+
+		do {
+		  ... (a for the parameter, rand ## exit for namespace ## exit)
+		} while (0);
+
+		Macro calls in the expanded body are expanded in turn.
+		A macro call within its own expansion (recursion) or out of
+		a statement can't be expanded and is put back as a plain call.
+		"""
+		# Only statements can be replaced by do-while.
+		STMT_SLOTS = ("block_items", "stmts", "stmt", "iftrue", "iffalse")
+
+		def __init__(self, macros):
+			self.macros = macros # name -> Macro
+			self.expanding = []
+
+		def visit_FuncCall(self, n):
+			name = rewrite.FuncCallName(n)
+			if not name in self.macros:
+				ext_pycparser.NodeVisitor.generic_visit(self, n)
+				return
+
+			parent, slot = self.current_parent, self.current_name
+			if not slot.split("[")[0] in self.STMT_SLOTS or name in self.expanding:
+				self.unmacroize(n)
+				ext_pycparser.NodeVisitor.generic_visit(self, n)
+				return
+			ext_pycparser.NodeVisitor.rewrite(parent, slot, self.expand(name, n))
+
+		def unmacroize(self, call):
+			"""
+			macro_f(namespace, a) -> f(a)
+
+			The definition of f is kept because its macro is expanded elsewhere.
+			"""
+			call.name.name = call.name.name[len("macro_"):]
+			call.args.exprs.pop(0)
+			if not call.args.exprs:
+				call.args = None
+
+		def expand(self, name, call):
+			macro = self.macros[name]
+			namespace = call.args.exprs[0].name
+			args = call.args.exprs[1:]
+			if len(args) != len(macro.params):
+				raise RuntimeError("[Error] Macro %s takes %d arguments\n" % (name, len(macro.params)))
+
+			body = ext_pycparser.clone(macro.body)
+			Main.Substitute(namespace, dict(zip(macro.params, args))).visit(body)
+
+			self.expanding.append(name)
+			self.visit(body)
+			self.expanding.pop()
+			return c_ast.DoWhile(c_ast.Constant("int", "0"), body)
+
+	def expandMacros(self, macros):
 		try:
-			cpped_txt = utils.preprocess_file(fn, cpp_path='gcc', cpp_args=['-E'])
-			if cpped_txt.find("macro_void_") != -1:
-				raise RuntimeError("[Error] Some macros weren't expanded")
-			self.ast = ext_pycparser.ast_of(cpped_txt)
+			self.ExpandMacros(macros).visit(self.ast)
 		except Exception as e:
 			sys.stderr.write(e.message)
 			sys.exit(1)
-		finally:
-			os.remove(fn)
 
 	class NormalizeLabels(ext_pycparser.NodeVisitor):
 		def __init__(self):
@@ -104,7 +194,7 @@ class Main:
 
 		def do_visit(self, n):
 			if n.name not in self.m:
-				self.m[n.name] = rewrite.newrandstr()
+				self.m[n.name] = rewrite.newName(rewrite.LABEL, None)
 			n.name = self.m[n.name]
 
 		def visit_Goto(self, n):
@@ -117,26 +207,36 @@ class Main:
 	def normalizeLabels(self):
 		self.NormalizeLabels().visit(self.ast)
 
-	def rewriteCallers(self, macroizables):
-		for (_, func) in rewrite.t.all_funcs.values():
-			RewriteCaller(func, macroizables).visit(func)
-		recorder.t.file_record("rewrite_func_call", ext_pycparser.CGenerator().visit(self.ast))
+	def rewriteCallers(self, macroizables, expanded, macros):
+		def rewriteCaller(func):
+			"""
+			Return the function only if rewritten
+			"""
+			if not ext_pycparser.Result(RewriteCaller(func, macroizables, expanded)).visit(func):
+				return None
+			return func
+
+		# The other macroizables are put back as they were
+		funcs = [(i, func) for i, func in rewrite.t.callers(macroizables)
+			if not ext_pycparser.FuncDef(func).name() in macroizables - macros]
+		rewritten = parallel.map(rewriteCaller, [func for _, func in funcs])
+		for (i, _), func in zip(funcs, rewritten):
+			if func:
+				rewrite.t.replaceFunc(self.ast, i, func)
+		recorder.t.file_record("rewrite_func_call", lambda: ext_pycparser.CGenerator().visit(self.ast))
 
 	def rewriteDefs(self, macroizables):
-		runners = []
-		for name in macroizables:
-			i, func = rewrite.t.all_funcs[name]
+		def rewriteDef(func):
 			runner = rewrite_void_fun.Main(func)
-			runners.append((i, runner))
-
-		for i, runner in runners:
 			runner.sanitizeNames()
-		recorder.t.file_record("sanitize_names", ext_pycparser.CGenerator().visit(self.ast))
-
-		for i, runner in reversed(runners):
 			runner.insertGotoLabel().show().rewriteReturnToGoto().show().appendNamespaceToLabels().show().macroize().show()
-			self.ast.ext[i] = runner.returnAST()
-		recorder.t.file_record("macroize", ext_pycparser.CGenerator().visit(self.ast))
+			return runner.returnAST()
+
+		funcs = [rewrite.t.all_funcs[name] for name in macroizables]
+		macros = parallel.map(rewriteDef, [func for _, func in funcs])
+		for (i, _), macro in zip(funcs, macros):
+			self.ast.ext[i] = macro
+		recorder.t.file_record("macroize", lambda: ext_pycparser.CGenerator().visit(self.ast))
 
 	class PurgeInlines(ext_pycparser.NodeVisitor):
 		"""
@@ -159,30 +259,22 @@ class Main:
 				n.funcspec.remove("inline")
 
 	def prependPrototypes(self):
-		all_funcdefs = []
+		splice = ext_pycparser.Splice(self.ast.ext)
 		for i, n in enumerate(self.ast.ext):
 			if isinstance(n, c_ast.FuncDef):
-				all_funcdefs.append((i, n))
-
-		for i, n in reversed(all_funcdefs):
-			decl = copy.deepcopy(n.decl)
-			self.ast.ext.insert(i, decl)
+				# The type is shared with the definition. No pass changes it from here.
+				splice.insert(i, ext_pycparser.copy_node(n.decl))
+		splice.apply()
 
 	def moveDecls(self):
 		"""
 		Move all Decls and Typedefs to the head of the file in order
 		"""
-		all_decls = []
+		splice = ext_pycparser.Splice(self.ast.ext)
 		for i, n in enumerate(self.ast.ext):
-			shouldMove = False
 			if isinstance(n, (c_ast.Typedef, c_ast.Decl)):
-				shouldMove = True
-			if shouldMove:
-				all_decls.append((i, n))
-		all_decls.sort(key=lambda x: -x[0])
-		for k, (i, n) in enumerate(all_decls):
-			self.ast.ext.insert(0, n)
-			del self.ast.ext[i+k+1]
+				splice.move(i, 0)
+		splice.apply()
 
 	# class AllIDs(c_ast.NodeVisitor, compound.SymbolTableMixin):
 	# 	def __init__(self, func, allDeclNames):
@@ -305,19 +397,26 @@ class Main:
 			if ext_pycparser.FuncDef(func).returnVoid():
 				macroizables.add(name)
 
+		expanded = rewrite.t.expandedCalls(macroizables)
+		# Only the macros expanded somewhere are made.
+		# The other macroizables are never copied nor rewritten.
+		macro_names = rewrite.t.expandedMacros(macroizables, expanded)
+
 		# We keep the original FuncDefs and revive them after the
 		# corresponding functions and their callers are transformed.
 		orig_funcs = []
-		for name in macroizables:
+		for name in macro_names:
 			i, func = rewrite.t.all_funcs[name]
-			orig_funcs.append((i, copy.deepcopy(func)))
+			orig_funcs.append((i, ext_pycparser.clone(func)))
 		orig_funcs.sort(key=lambda x: -x[0]) # reversed order by lineno
 
-		self.rewriteCallers(macroizables)
+		with timing.t.phase("rewrite_callers"):
+			self.rewriteCallers(macroizables, expanded, macro_names)
 
 		# After macroize() calls within macroized functions are expanded.
 		# We need to rewrite callers before that.
-		self.rewriteDefs(macroizables)
+		with timing.t.phase("rewrite_defs"):
+			self.rewriteDefs(macro_names)
 
 		macro_funcs = []
 		for i, _ in orig_funcs:
@@ -328,24 +427,25 @@ class Main:
 
 		self.PurgeInlines().visit(self.ast)
 
-		self.prependPrototypes()
-		recorder.t.file_record("prepend_prototypes", ext_pycparser.CGenerator().visit(self.ast))
-
-		self.moveDecls()
-		recorder.t.file_record("move_decls", ext_pycparser.CGenerator().visit(self.ast))
+		with timing.t.phase("prepend_prototypes"):
+			self.prependPrototypes()
+		recorder.t.file_record("prepend_prototypes", lambda: ext_pycparser.CGenerator().visit(self.ast))
 
-		for _, mfunc in macro_funcs:
-			self.ast.ext.insert(0, mfunc)
-		recorder.t.file_record("insert_macros", ext_pycparser.CGenerator().visit(self.ast))
-		# print ext_pycparser.CGenerator().visit(self.ast)
+		with timing.t.phase("move_decls"):
+			self.moveDecls()
+		recorder.t.file_record("move_decls", lambda: ext_pycparser.CGenerator().visit(self.ast))
 
-		self.applyPreprocess() # Apply cpp is necessary for the later stages.
-		recorder.t.file_record("apply_preprocess", ext_pycparser.CGenerator().visit(self.ast))
+		# The macros are expanded in AST. They are not written out.
+		macros = dict([(mfunc.name, mfunc) for _, mfunc in macro_funcs])
+		with timing.t.phase("expand_macros"):
+			self.expandMacros(macros)
+		recorder.t.file_record("expand_macros", lambda: ext_pycparser.CGenerator().visit(self.ast))
 
 		if NORMALIZE_LABEL:
 			# Normalize labels to fixed length. Some compilers won't allow labels too long.
-			self.normalizeLabels()
-		recorder.t.file_record("normalize_labels", ext_pycparser.CGenerator().visit(self.ast))
+			with timing.t.phase("normalize_labels"):
+				self.normalizeLabels()
+		recorder.t.file_record("normalize_labels", lambda: ext_pycparser.CGenerator().visit(self.ast))
 
 		# FIXME I think now this makes no sence at all because of moveDecls()
 		# self.prependDecls()
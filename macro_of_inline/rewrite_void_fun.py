@@ -1,60 +1,54 @@
 from pycparser import c_parser, c_ast
 
 import collections
-import copy
 import enum
 
 import cfg
+import compound
 import ext_pycparser
 import recorder
 import rewrite
 import utils
 
-Symbol = collections.namedtuple('Symbol', 'alias, overwritable')
+Symbol = collections.namedtuple('Symbol', 'alias, level')
 
-# False -> ($oldname -> $randstr)
-# True  -> ($oldname -> ($oldname_$randstr))
-VERBOSE = True
+class NameTable(compound.Scopes):
+	"""
+	name -> Symbol
 
-class NameTable:
-	def __init__(self):
-		self.table = {}
-		self.prev_table = None
+	A symbol declared in the outer block is overwritable
+	by the declaration in the current block.
+	"""
+	def __init__(self, func_name):
+		compound.Scopes.__init__(self)
+		self.func_name = func_name
 
 	def register(self, name):
-		alias = rewrite.newrandstr()
-		if VERBOSE:
-			alias = "%s_%s" % (name, alias)
-		self.table[name] = Symbol(alias, overwritable=False)
+		alias = rewrite.newName(rewrite.LOCAL_VAR, self.func_name)
+		self.bind(name, Symbol(alias, self.level()))
+
+	def overwritable(self, symbol):
+		return symbol.level < self.level()
 
 	def declare(self, name):
-		if name in self.table:
-			if self.table[name].overwritable:
-				self.register(name)
-		else:
+		symbol = self.lookup(name)
+		if not symbol or self.overwritable(symbol):
 			self.register(name)
 
 	def alias(self, name):
-		if name in self.table:
-			return self.table[name].alias
+		symbol = self.lookup(name)
+		if symbol:
+			return symbol.alias
 		else:
-			return name	
+			return name
 
-	def clone(self):
-		new = {}
-		for name in self.table:
-			new[name] = Symbol(self.table[name].alias, overwritable=True)
-		nt = NameTable()
-		nt.table = new
-		return nt
-	
 	def show(self):
 		if not utils.DEBUG:
 			return
 		print("NameTable")
 		for name in self.table:
 			tup = self.table[name]
-			print("  %s -> (alias:%s, overwritable:%r)" % (name, tup.alias, tup.overwritable))
+			print("  %s -> (alias:%s, overwritable:%r)" % (name, tup.alias, self.overwritable(tup)))
 
 class RenameVars(ext_pycparser.NodeVisitor):
 	def __init__(self, init_table):
@@ -105,13 +99,11 @@ class RenameVars(ext_pycparser.NodeVisitor):
 	def switchTable(self):
 		utils.P("switch table")
 		self.cur_table.show()
-		new_table = self.cur_table.clone()
-		new_table.prev_table = self.cur_table
-		self.cur_table = new_table
+		self.cur_table.push()
 
 	def revertTable(self):
 		utils.P("revert table")
-		self.cur_table = self.cur_table.prev_table
+		self.cur_table.pop()
 
 GOTO_LABEL = "exit"
 
@@ -165,7 +157,7 @@ class Main(ext_pycparser.FuncDef):
 			self.func.show()
 
 		self.args = []
-		self.init_table = NameTable()
+		self.init_table = NameTable(self.name())
 
 		# We consider f(void) as f() that truly doesn't have arguments as AST-level.
 		if self.voidArgs():
@@ -229,23 +221,28 @@ class Main(ext_pycparser.FuncDef):
 		if not block_items:
 			return self
 
+		decls = []
 		for arg in reversed(self.args):
 			if arg.shouldInsertDecl():
-				newname = rewrite.newrandstr()
+				newname = rewrite.newName(rewrite.ARG, self.name())
 
 				# Insert decl line
 				oldname = arg.node.name
-				if VERBOSE:
-					newname = "%s_%s" % (oldname, newname)
 
-				decl = copy.deepcopy(arg.node)
+				decl = ext_pycparser.clone(arg.node)
 				alias = self.init_table.alias(oldname)
 				self.renameDecl(decl, alias)
 				decl.init = c_ast.ID(newname)
-				block_items.insert(0, decl)
+				decls.append(decl)
 
 				# Rename the arg
 				self.renameDecl(arg.node, newname)
+
+		# In the order of the args
+		splice = ext_pycparser.Splice(block_items)
+		for decl in reversed(decls):
+			splice.insert(0, decl)
+		splice.apply()
 		return self
 
 	def sanitizeNames(self):
@@ -253,7 +250,7 @@ class Main(ext_pycparser.FuncDef):
 
 	class InsertGotoLabel(ext_pycparser.NodeVisitor):
 		"""
-		Renames the identifiers by random sequence so that they never conflicts others.
+		Renames the identifiers by generated names so that they never conflicts others.
 
 		{
 		  ...
@@ -320,19 +317,8 @@ class Main(ext_pycparser.FuncDef):
 		if not self.ok: return self
 
 		fun_name = "macro_%s" % self.name()
-		args = ', '.join(["namespace"] + map(lambda arg: arg.node.name, self.args))
-		generator = ext_pycparser.CGenerator()
-		body_contents = generator.visit(self.func.body).splitlines()[1:-1]
-		if not len(body_contents):
-			body_contents = [""]
-		body = '\n'.join(map(lambda x: "%s \\" % x, body_contents))
-		macro = r"""
-#define %s(%s) \
-do { \
-%s
-} while(0)
-""" % (fun_name, args, body)
-		self.func = ext_pycparser.Any(macro)
+		params = map(lambda arg: arg.node.name, self.args)
+		self.func = ext_pycparser.Macro(fun_name, params, self.func.body)
 		return self
 
 	def returnAST(self):
@@ -0,0 +1,101 @@
+import SocketServer
+import StringIO
+import json
+import os
+import signal
+import sys
+import traceback
+
+import cfg
+import cli
+import ext_pycparser
+import recorder
+import rewrite
+
+ENCODING = "latin-1" # Pass any bytes of C source through JSON
+
+def response_of(status, stdout, stderr):
+	return json.dumps({"status": status, "stdout": stdout, "stderr": stderr}, encoding=ENCODING)
+
+def recv_all(sock):
+	chunks = []
+	while True:
+		chunk = sock.recv(65536)
+		if not chunk:
+			break
+		chunks.append(chunk)
+	return ''.join(chunks)
+
+def handle(argv, cwd):
+	"""
+	Run the command line of a request.
+	Return (status, stdout, stderr)
+	"""
+	stdout = StringIO.StringIO()
+	stderr = StringIO.StringIO()
+	sys.stdout, sys.stderr = stdout, stderr
+	try:
+		os.chdir(cwd)
+		args = cli.parse(argv)
+		if args.server:
+			raise RuntimeError("[Error] --server can't be requested")
+		cli.configure(args)
+		recorder.reset()
+		rewrite.reset()
+		status = cli.run(args)
+	except SystemExit as e:
+		status = e.code
+		if status == None:
+			status = 0
+		elif not isinstance(status, int):
+			sys.stderr.write("%s\n" % status)
+			status = 1
+	except Exception as e:
+		traceback.print_exc()
+		status = 1
+	finally:
+		sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+	return (status, stdout.getvalue(), stderr.getvalue())
+
+class Handler(SocketServer.BaseRequestHandler):
+	"""
+	Each request is handled in its own forked process.
+	cfg.t, rewrite.t and recorder.t are set up from scratch there so
+	requests never see each other while the parent stays warm.
+	"""
+	def handle(self):
+		req = json.loads(recv_all(self.request), encoding=ENCODING)
+		argv = [x.encode(ENCODING) for x in req["argv"]]
+		status, stdout, stderr = handle(argv, req["cwd"].encode(ENCODING))
+		self.request.sendall(response_of(status, stdout, stderr))
+
+class Server(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+	pass
+
+def warmUp():
+	"""
+	Build a parser and parse the fake include of the server's options
+	in the parent so that every request inherits them
+	"""
+	ext_pycparser.ast_of("")
+	if cfg.t.fake_include:
+		rewrite.fake_include_ast(cfg.t.fake_include)
+
+def serve(path):
+	if os.path.exists(path):
+		os.remove(path)
+
+	warmUp()
+	server = Server(path, Handler)
+
+	def terminate(signum, frame):
+		raise KeyboardInterrupt()
+	signal.signal(signal.SIGTERM, terminate)
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.remove(path)
@@ -0,0 +1,137 @@
+import contextlib
+import ctypes
+import ctypes.util
+import json
+import sys
+import time
+
+import cfg
+
+class timespec(ctypes.Structure):
+	_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def monotonic_clock():
+	"""
+	() -> (() -> seconds)
+
+	Python 2 has no monotonic clock.
+	We call clock_gettime(CLOCK_MONOTONIC) of libc and
+	fall back to time.time() where it's not available.
+	"""
+	if not sys.platform.startswith("linux"):
+		return time.time
+	CLOCK_MONOTONIC = 1
+	for lib in (None, ctypes.util.find_library("rt")):
+		try:
+			clock_gettime = ctypes.CDLL(lib, use_errno=True).clock_gettime
+		except (OSError, AttributeError):
+			continue
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+		def monotonic():
+			ts = timespec()
+			if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+				return time.time()
+			return ts.tv_sec + ts.tv_nsec * 1e-9
+		return monotonic
+	return time.time
+
+monotonic = monotonic_clock()
+
+class Timings:
+	"""
+	Elapsed times of the pipeline phases of a file (--profile).
+
+	Phases nest and are named by their paths (e.g. rewrite_void/expand_macros).
+	They are listed in the order they started.
+	Nothing is measured unless cfg.t.profile is set.
+	"""
+	def __init__(self, filename=None):
+		self.filename = filename
+		self.stack = []
+		self.phases = [] # [{"name": path, "seconds": s}]
+		self.started = monotonic()
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		if not cfg.t.profile:
+			yield
+			return
+
+		self.stack.append(name)
+		entry = {"name": "/".join(self.stack), "seconds": None}
+		self.phases.append(entry)
+		start = monotonic()
+		try:
+			yield
+		finally:
+			entry["seconds"] = monotonic() - start
+			self.stack.pop()
+
+	def report(self):
+		return {
+			"file": self.filename,
+			"total": monotonic() - self.started,
+			"phases": self.phases,
+		}
+
+t = Timings()
+
+def reset(filename):
+	"""
+	Start measuring another file
+	"""
+	global t
+	t = Timings(filename)
+
+def aggregate(reports):
+	"""
+	[report] -> report of all the files
+
+	Files are sorted by the total time and phases by the sum of their times,
+	both slowest first.
+	"""
+	phases = {}
+	for report in reports:
+		for entry in report["phases"]:
+			if entry["seconds"] is None:
+				continue
+			name = entry["name"]
+			if not name in phases:
+				phases[name] = {"name": name, "total": 0.0, "count": 0, "max": 0.0, "max_file": None}
+			x = phases[name]
+			x["total"] += entry["seconds"]
+			x["count"] += 1
+			if entry["seconds"] >= x["max"]:
+				x["max"] = entry["seconds"]
+				x["max_file"] = report["file"]
+	for x in phases.values():
+		x["mean"] = x["total"] / x["count"]
+
+	return {
+		"total": sum([report["total"] for report in reports]),
+		"phases": sorted(phases.values(), key=lambda x: -x["total"]),
+		"files": sorted(reports, key=lambda x: -x["total"]),
+	}
+
+def write(filename, report):
+	with open(filename, "w") as fp:
+		json.dump(report, fp, indent=2, sort_keys=True, separators=(",", ": "))
+		fp.write("\n")
+
+if __name__ == "__main__":
+	cfg.t.profile = True
+	reset("a.c")
+	with t.phase("parse"):
+		with t.phase("lex"):
+			pass
+	assert([x["name"] for x in t.phases] == ["parse", "parse/lex"])
+	a = t.report()
+	reset("b.c")
+	with t.phase("parse"):
+		time.sleep(0.01)
+	b = t.report()
+	report = aggregate([a, b])
+	assert(report["files"][0]["file"] == "b.c")
+	assert(report["phases"][0]["name"] == "parse")
+	assert(report["phases"][0]["count"] == 2)
+	assert(report["phases"][0]["max_file"] == "b.c")
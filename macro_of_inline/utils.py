@@ -1,8 +1,10 @@
 import cfg
+import os
 import pycparser
 import random
 import string
 import subprocess
+import timing
 
 DEBUG = False
 
@@ -11,20 +13,9 @@ def P(s):
 		return
 	print(s)
 
-N = 16
 def randstr(n):
 	return ''.join(random.choice(string.letters) for i in xrange(n))
 
-def newrandstr(names, n):
-	while True:
-		alias = randstr(n)
-		if alias in names:
-			continue
-		else:
-			names.add(alias)
-			break
-	return alias
-
 def countMap(xs):
 	m = {}
 	for x in xs:
@@ -54,6 +45,18 @@ def to_option(x):
 	return ''.join(l)
 
 def preprocess_file(filename, cpp_path, cpp_args=''):
+	return run_cpp(filename, cpp_path, cpp_args)
+
+def preprocess_text(text, cpp_path, cpp_args=''):
+	"""
+	Text -> Text
+
+	The text is fed to the stdin of cpp and the output is taken
+	from the pipe. No file is written.
+	"""
+	return run_cpp('-', cpp_path, cpp_args, text)
+
+def run_cpp(filename, cpp_path, cpp_args='', text=None):
 	path_list = [cpp_path]
 	if isinstance(cpp_args, list):
 		path_list += cpp_args
@@ -61,9 +64,11 @@ def preprocess_file(filename, cpp_path, cpp_args=''):
 		path_list += [cpp_args]
 	path_list += [filename]
 	try:
-		pipe = subprocess.Popen(path_list, stdout=subprocess.PIPE, universal_newlines=True)
-		text = pipe.communicate()[0]
-		ret = pipe.returncode
+		with timing.t.phase("subprocess:%s" % cpp_path):
+			stdin = subprocess.PIPE if text != None else None
+			pipe = subprocess.Popen(path_list, stdin=stdin, stdout=subprocess.PIPE, universal_newlines=True)
+			text = pipe.communicate(text)[0]
+			ret = pipe.returncode
 		if ret:
 			raise RuntimeError("[Error] Preprocessing failed. Code: %d\n" % ret)
 	except OSError as e:
@@ -72,6 +77,22 @@ def preprocess_file(filename, cpp_path, cpp_args=''):
 			('Original error: %s' % e))
 	return text
 
+def write_file(filename, write):
+	"""
+	Call write(fp) to write the file.
+
+	The file may be the input. Never leave it half-written.
+	"""
+	tmp = "%s.%d.tmp" % (filename, os.getpid())
+	try:
+		with open(tmp, "w") as fp:
+			write(fp)
+	except:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+	os.rename(tmp, filename)
+
 def cpp(filename):
 	"""
 	File -> Text
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+Corpus benchmark.
+
+Runs macro-of-inline over a local corpus of preprocessed snapshots (.i files)
+and records the run into a SQLite file: throughput (files per second),
+time per phase, peak memory of the workers and success rate.
+The outputs are thrown away. The snapshots are never modified.
+
+Each run is tagged with the commit of macro-of-inline so that
+two commits can be compared on the same corpus:
+
+  $ python tests/bench/corpus.py snapshot ruby-src ruby-corpus -X _I./include
+  $ python tests/bench/corpus.py run ruby-corpus --fake-include tests/ruby_fake_include.h
+  $ git checkout other-branch
+  $ python tests/bench/corpus.py run ruby-corpus --fake-include tests/ruby_fake_include.h
+  $ python tests/bench/corpus.py compare master other-branch
+
+usage: python tests/bench/corpus.py {snapshot,run,history,compare} ...
+"""
+
+import argparse
+import datetime
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(ROOT, "macro_of_inline"))
+
+import cfg
+
+DEFAULT_DB = "macro-of-inline-bench.sqlite"
+
+SCHEMA = """
+create table if not exists runs (
+	id integer primary key,
+	started text,
+	git_commit text,
+	corpus text,
+	files integer,
+	failures integer,
+	seconds real,
+	files_per_second real,
+	peak_rss integer,
+	jobs integer
+);
+create table if not exists phases (
+	run_id integer,
+	name text,
+	total real,
+	count integer,
+	max real,
+	max_file text
+);
+create table if not exists files (
+	run_id integer,
+	file text,
+	seconds real,
+	error text
+);
+"""
+
+def connect(path):
+	db = sqlite3.connect(path)
+	db.row_factory = sqlite3.Row
+	db.executescript(SCHEMA)
+	return db
+
+def git_commit():
+	"""
+	Short commit of the tree being measured. "-dirty" is appended
+	if macro_of_inline has uncommitted changes.
+	"""
+	def git(*args):
+		return subprocess.Popen(["git"] + list(args), cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+	commit = git("rev-parse", "--short", "HEAD") or "unknown"
+	if git("diff", "--name-only", "HEAD", "--", "macro_of_inline"):
+		commit += "-dirty"
+	return commit
+
+def snapshots(dirname):
+	files = []
+	for dirpath, dirnames, filenames in os.walk(dirname):
+		dirnames.sort()
+		for fn in sorted(filenames):
+			if fn.endswith(".i"):
+				files.append(os.path.join(dirpath, fn))
+	return files
+
+def snapshot(args):
+	"""
+	Preprocess the .c files under SRC into .i files under DEST
+	"""
+	import batch
+	import utils
+
+	cfg.t.extra_options = args.cpp_args
+	src = os.path.abspath(args.src)
+	nr_failures = 0
+	for filename in batch.collect([src]):
+		output = os.path.join(args.dest, os.path.relpath(filename, src))[:-2] + ".i"
+		try:
+			cwd = os.getcwd()
+			os.chdir(os.path.dirname(filename))
+			try:
+				txt = utils.cpp(filename)
+			finally:
+				os.chdir(cwd)
+		except RuntimeError as e:
+			sys.stderr.write("[snapshot] failed: %s (%s)\n" % (filename, str(e).strip()))
+			nr_failures += 1
+			continue
+		if not os.path.exists(os.path.dirname(output)):
+			os.makedirs(os.path.dirname(output))
+		with open(output, "w") as fp:
+			fp.write(txt)
+	return 1 if nr_failures else 0
+
+def run(args):
+	import batch
+	import timing
+
+	cfg.t.fake_include = args.fake_include and os.path.abspath(args.fake_include)
+	cfg.t.profile = True # The workers send the timings back
+
+	files = snapshots(args.corpus)
+	if not files:
+		sys.stderr.write("no .i file in %s\n" % args.corpus)
+		return 1
+
+	output_dir = tempfile.mkdtemp(prefix="bench-macro-of-inline-")
+	try:
+		started = datetime.datetime.now().isoformat()
+		t = timing.monotonic()
+		runner = batch.Batch(files, output_dir, args.j, args.timeout).run()
+		seconds = timing.monotonic() - t
+	finally:
+		shutil.rmtree(output_dir)
+
+	# Every worker has been joined. ru_maxrss is in kilobytes on Linux.
+	peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+	report = timing.aggregate([r for _, _, _, r in runner.results if r])
+
+	db = connect(args.db)
+	with db:
+		cur = db.execute("insert into runs (started, git_commit, corpus, files, failures, seconds, files_per_second, peak_rss, jobs) values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+			(started, git_commit(), os.path.abspath(args.corpus), len(files), len(runner.failures()),
+			seconds, len(files) / seconds, peak_rss, runner.nr_workers))
+		run_id = cur.lastrowid
+		db.executemany("insert into phases (run_id, name, total, count, max, max_file) values (?, ?, ?, ?, ?, ?)",
+			[(run_id, x["name"], x["total"], x["count"], x["max"], x["max_file"]) for x in report["phases"]])
+		db.executemany("insert into files (run_id, file, seconds, error) values (?, ?, ?, ?)",
+			[(run_id, filename, elapsed, error) for filename, error, elapsed, _ in runner.results])
+
+	print_run(db.execute("select * from runs where id = ?", (run_id,)).fetchone())
+	return 0
+
+def success_rate(row):
+	return 100.0 * (row["files"] - row["failures"]) / row["files"]
+
+def print_run(row):
+	print("#%d %s %s %s" % (row["id"], row["git_commit"], row["started"], row["corpus"]))
+	print("  %.2f files/s  %.1f%% success (%d/%d)  %.1fs  peak %.1fMB  -j %d" % (
+		row["files_per_second"], success_rate(row), row["files"] - row["failures"], row["files"],
+		row["seconds"], row["peak_rss"] / 1024.0 / 1024.0, row["jobs"]))
+
+def history(args):
+	db = connect(args.db)
+	for row in db.execute("select * from runs order by id"):
+		print_run(row)
+	return 0
+
+def find_run(db, rev, corpus):
+	"""
+	The latest run of the commit (or "#ID" for a run)
+	"""
+	if rev.startswith("#"):
+		return db.execute("select * from runs where id = ?", (int(rev[1:]),)).fetchone()
+	query = "select * from runs where git_commit like ?"
+	params = [rev + "%"]
+	if corpus:
+		query += " and corpus = ?"
+		params.append(corpus)
+	# Branch names and tags are resolved by git
+	commit = subprocess.Popen(["git", "rev-parse", "--short", rev], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+	if commit:
+		params[0] = commit + "%"
+	return db.execute(query + " order by id desc limit 1", params).fetchone()
+
+def compare(args):
+	db = connect(args.db)
+	corpus = args.corpus and os.path.abspath(args.corpus)
+	a = find_run(db, args.a, corpus)
+	if not a:
+		sys.stderr.write("no run of %s\n" % args.a)
+		return 1
+	b = find_run(db, args.b, corpus or a["corpus"])
+	if not b:
+		sys.stderr.write("no run of %s on %s\n" % (args.b, corpus or a["corpus"]))
+		return 1
+
+	print_run(a)
+	print_run(b)
+
+	def change(x, y):
+		return 100.0 * (y - x) / x if x else 0.0
+
+	print("")
+	print("%-48s %12s %12s %8s" % ("", "A", "B", "change"))
+	print("%-48s %12.2f %12.2f %7.1f%%" % ("files/s", a["files_per_second"], b["files_per_second"], change(a["files_per_second"], b["files_per_second"])))
+	print("%-48s %12.1f %12.1f %7.1f%%" % ("success %", success_rate(a), success_rate(b), change(success_rate(a), success_rate(b))))
+	print("%-48s %12.1f %12.1f %7.1f%%" % ("peak MB", a["peak_rss"] / 1048576.0, b["peak_rss"] / 1048576.0, change(a["peak_rss"], b["peak_rss"])))
+
+	# Mean time per file of each phase
+	def phases(run):
+		return dict([(row["name"], row["total"] / row["count"]) for row in db.execute("select * from phases where run_id = ?", (run["id"],))])
+	pa = phases(a)
+	pb = phases(b)
+	print("")
+	print("%-48s %12s %12s %8s" % ("phase [ms/file]", "A", "B", "change"))
+	for name in sorted(set(pa) | set(pb), key=lambda x: -max(pa.get(x, 0), pb.get(x, 0))):
+		x = pa.get(name)
+		y = pb.get(name)
+		print("%-48s %12s %12s %8s" % (name,
+			"-" if x is None else "%.2f" % (x * 1000),
+			"-" if y is None else "%.2f" % (y * 1000),
+			"-" if x is None or y is None else "%.1f%%" % change(x, y)))
+
+	slowdown = -change(a["files_per_second"], b["files_per_second"])
+	if slowdown > args.tolerance:
+		print("")
+		print("regression: throughput is down by %.1f%% (tolerance %.1f%%)" % (slowdown, args.tolerance))
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="corpus benchmark of macro-of-inline")
+	parser.add_argument("--db", metavar="FILE", default=DEFAULT_DB, help="results history (default:%s)" % DEFAULT_DB)
+	commands = parser.add_subparsers()
+
+	p = commands.add_parser("snapshot", help="preprocess the .c files of a source tree into a corpus")
+	p.add_argument("src", metavar="SRC")
+	p.add_argument("dest", metavar="DEST")
+	p.add_argument("-X", "--cpp-args", nargs="+", metavar="OPTION", default=[], help="extra options to preprocessor (e.g. _Ipath _DHOGE)")
+	p.set_defaults(func=snapshot)
+
+	p = commands.add_parser("run", help="process the .i files under CORPUS and record the run")
+	p.add_argument("corpus", metavar="CORPUS")
+	p.add_argument("--fake-include", metavar="FILE", help="fake include to deceive pycparser by adding fake typedefs")
+	p.add_argument("-j", metavar="N", type=int, help="number of worker processes (default: number of cpus)")
+	p.add_argument("--timeout", metavar="SEC", type=float, help="time limit per file (default: no limit)")
+	p.set_defaults(func=run)
+
+	p = commands.add_parser("history", help="list the recorded runs")
+	p.set_defaults(func=history)
+
+	p = commands.add_parser("compare", help="compare the latest runs of two commits (or #ID for a run)")
+	p.add_argument("a", metavar="A")
+	p.add_argument("b", metavar="B")
+	p.add_argument("--corpus", metavar="CORPUS", help="(default: the corpus of the run of A)")
+	p.add_argument("--tolerance", metavar="PERC", type=float, default=5.0, help="exit with 1 if the throughput is down by more than PERC%% (default:5)")
+	p.set_defaults(func=compare)
+
+	args = parser.parse_args()
+	sys.exit(args.func(args))
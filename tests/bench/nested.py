@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Nested call benchmark.
+
+Measures the pop_nested phase of rewrite_non_void on a synthetic function
+that has N statements of the form r = f(f(...f(0)...)) (depth D).
+The cost per nested call should stay flat as N and D grow.
+
+usage: python tests/bench/nested.py [-d D] [N ...]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(ROOT, "macro_of_inline"))
+
+import ext_pycparser
+import rewrite
+import rewrite_non_void
+
+def synthesize(n, depth):
+	call = "0"
+	for i in xrange(depth):
+		call = "f(%s)" % call
+	lines = []
+	lines.append("inline int f(int x) { return x; }")
+	lines.append("int main(void)")
+	lines.append("{")
+	lines.append("\tint r;")
+	for i in xrange(n):
+		lines.append("\tr = %s;" % call)
+	lines.append("\treturn r;")
+	lines.append("}")
+	return '\n'.join(lines)
+
+def pop_nested(n, depth):
+	"""
+	Return the time in milliseconds
+	"""
+	rewrite.reset()
+	ast = ext_pycparser.ast_of(synthesize(n, depth))
+	rewrite.t.setupAST(ast)
+	_, func = rewrite.t.all_funcs["main"]
+	t = time.time()
+	# Until no nested call is left
+	while ext_pycparser.Result(rewrite_non_void.RewriteCaller.PopNested(func, set(["f"]))).visit(func):
+		pass
+	return (time.time() - t) * 1000
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="nested call benchmark of macro-of-inline")
+	parser.add_argument("-d", type=int, default=4, help="depth of the nested calls (default:4)")
+	parser.add_argument("sizes", metavar="N", type=int, nargs="*", default=[250, 500, 1000, 2000])
+	args = parser.parse_args()
+
+	for n in args.sizes:
+		calls = n * (args.d - 1)
+		ms = pop_nested(n, args.d)
+		print("%6d nested calls  %9.3f[ms]  %7.4f[ms/call]" % (calls, ms, ms / calls))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Recorder benchmark.
+
+Measures a whole run of rewrite.Main in the process with --record off,
+and with --record on for reference. With --record off the recorder
+should cost nothing: no C text is generated for the records.
+
+usage: python tests/bench/record.py [-n N] [FILE]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(ROOT, "macro_of_inline"))
+
+import cfg
+
+DEFAULT_FILE = os.path.join(ROOT, "tests", "proj", "main.c")
+
+def timeit(f, n):
+	"""
+	Return (min, mean) in milliseconds
+	"""
+	xs = []
+	for i in xrange(n):
+		t = time.time()
+		f()
+		xs.append((time.time() - t) * 1000)
+	return (min(xs), sum(xs) / len(xs))
+
+def report(title, (best, mean)):
+	print("%-24s min %9.3f[ms]  mean %9.3f[ms]" % (title, best, mean))
+
+def run(filename, record, n):
+	cfg.t = cfg.Env()
+	cfg.t.with_cpp = True
+	cfg.t.cpp_mode = "gcc"
+	cfg.t.extra_options = ["_I%s" % os.path.join(ROOT, "macro_of_inline", "fake_libc_include")]
+	if record:
+		cfg.t.record_enabled = True
+		cfg.t.record_dir = tempfile.mkdtemp(prefix="record-macro-of-inline-")
+
+	import recorder
+	import rewrite
+	def f():
+		recorder.reset()
+		rewrite.reset()
+		rewrite.Main(filename).run()
+	return timeit(f, n)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="recorder benchmark of macro-of-inline")
+	parser.add_argument("-n", type=int, default=5, help="iterations (default:5)")
+	parser.add_argument("file", metavar="FILE", nargs="?", default=DEFAULT_FILE)
+	args = parser.parse_args()
+
+	filename = os.path.abspath(args.file)
+	os.chdir(os.path.dirname(filename))
+	report("--record off", run(filename, False, args.n))
+	report("--record on", run(filename, True, args.n))
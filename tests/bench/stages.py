@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Stage benchmark.
+
+Grows each knob of the synthetic workload (see workload.py) and measures
+the stages of a run in the process: parsing, rewrite_non_void.Main and
+rewrite_void.Main (all within Wrap) and the rest of cppwrap.Apply
+(generating the text). The nodes of the headers are dropped within Wrap.
+
+The times are fitted to the size of the work on log-log scale: the input
+text for parsing and the input and the output text for the other stages.
+A stage whose slope exceeds --max-slope is flagged as super-linear
+and the exit code is 1. The ratio knob (non_void) is not fitted.
+
+usage: python tests/bench/stages.py [-n N] [--max-slope S] [KNOB[=V,V,...] ...]
+"""
+
+import argparse
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(ROOT, "macro_of_inline"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cfg
+import workload
+
+SERIES = [
+	("functions", [16, 32, 64, 128]),
+	("fanout", [1, 2, 3, 4]),
+	("depth", [2, 3, 4, 5]),
+	("body", [8, 16, 32, 64]),
+	("non_void", [0.0, 0.5, 1.0]),
+	("typedefs", [16, 64, 256, 1024]),
+]
+
+# Not the size of the work
+RATIOS = set(["non_void"])
+
+STAGES = [
+	("parse", "cppwrap/wrap/parse"),
+	("non_void", "cppwrap/wrap/rewrite_non_void"),
+	("void", "cppwrap/wrap/rewrite_void"),
+	("wrap", "cppwrap/wrap"),
+	("cppwrap", "cppwrap"),
+]
+
+# Too short to fit
+MIN_SECONDS = 0.01
+
+def run_once(filename):
+	"""
+	Return ({stage: seconds}, input size, output size)
+	"""
+	import cppwrap
+	import rewrite
+	import timing
+	import utils
+
+	rewrite.reset()
+	timing.reset(filename)
+	cpped_txt = utils.cpp(filename)
+
+	def f(txt):
+		with timing.t.phase("wrap"):
+			return rewrite.Wrap(txt, filename).run()
+	with timing.t.phase("cppwrap"):
+		output = cppwrap.Apply(f).onText(filename, cpped_txt)
+
+	seconds = dict([(x["name"], x["seconds"]) for x in timing.t.phases])
+	times = dict([(stage, seconds.get(name, 0.0)) for stage, name in STAGES])
+	# Apply without Wrap
+	times["cppwrap"] -= times["wrap"]
+	return (times, len(cpped_txt), len(output))
+
+def measure(knobs, n):
+	cfg.t = cfg.Env()
+	cfg.t.profile = True
+
+	dirname = tempfile.mkdtemp(prefix="bench-macro-of-inline-")
+	try:
+		filename = workload.Workload(**knobs).write(dirname)
+		best = None
+		for i in xrange(n):
+			times, input_size, output_size = run_once(filename)
+			if best is None:
+				best = times
+			else:
+				best = dict([(stage, min(best[stage], times[stage])) for stage in best])
+		return (best, input_size, output_size)
+	finally:
+		shutil.rmtree(dirname)
+
+def slope(points):
+	"""
+	[(size, seconds)] -> exponent k of seconds ~ size^k (least squares)
+	None if the points can't tell.
+	"""
+	points = [(x, y) for x, y in points if x > 0 and y > 0]
+	if len(points) < 2:
+		return None
+	xs = [math.log(x) for x, _ in points]
+	ys = [math.log(y) for _, y in points]
+	if max(xs) - min(xs) < math.log(2): # The work doesn't grow enough
+		return None
+	mx = sum(xs) / len(xs)
+	my = sum(ys) / len(ys)
+	sxx = sum([(x - mx) ** 2 for x in xs])
+	sxy = sum([(x - mx) * (y - my) for x, y in zip(xs, ys)])
+	return sxy / sxx
+
+def bench(knob, values, n, max_slope):
+	"""
+	Return the flagged stages
+	"""
+	print("%s:" % knob)
+	print("  %8s %10s %10s %s" % ("value", "input", "output", " ".join(["%10s" % stage for stage, _ in STAGES])))
+	results = []
+	for value in values:
+		knobs = dict(workload.DEFAULTS)
+		knobs[knob] = value
+		times, input_size, output_size = measure(knobs, n)
+		results.append((input_size, output_size, times))
+		print("  %8s %10d %10d %s" % (value, input_size, output_size, " ".join(["%8.1fms" % (times[stage] * 1000) for stage, _ in STAGES])))
+	if knob in RATIOS:
+		return []
+
+	flagged = []
+	slopes = []
+	for stage, _ in STAGES:
+		if stage == "parse":
+			points = [(input_size, times[stage]) for input_size, _, times in results]
+		else:
+			points = [(input_size + output_size, times[stage]) for input_size, output_size, times in results]
+		k = slope(points)
+		if k is None or max([y for _, y in points]) < MIN_SECONDS:
+			slopes.append("%10s" % "-")
+			continue
+		mark = ""
+		if k > max_slope:
+			mark = "!"
+			flagged.append("%s/%s" % (knob, stage))
+		slopes.append("%10s" % ("%.2f%s" % (k, mark)))
+	print("  %8s %10s %10s %s" % ("slope", "", "", " ".join(slopes)))
+	return flagged
+
+def parse_series(specs):
+	if not specs:
+		return SERIES
+	defaults = dict(SERIES)
+	series = []
+	for spec in specs:
+		knob, _, values = spec.partition("=")
+		if not knob in workload.DEFAULTS:
+			raise SystemExit("unknown knob: %s (%s)" % (knob, ", ".join(sorted(workload.DEFAULTS))))
+		if values:
+			conv = type(workload.DEFAULTS[knob])
+			series.append((knob, [conv(v) for v in values.split(",")]))
+		else:
+			series.append((knob, defaults[knob]))
+	return series
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="stage benchmark of macro-of-inline")
+	parser.add_argument("-n", type=int, default=3, help="iterations per point. the best time is taken (default:3)")
+	parser.add_argument("--max-slope", metavar="S", type=float, default=1.5, help="flag the stages that grow faster than size^S (default:1.5)")
+	parser.add_argument("knobs", metavar="KNOB[=V,V,...]", nargs="*", help="knobs to grow (default: all). knobs are %s" % ", ".join(sorted(workload.DEFAULTS)))
+	args = parser.parse_args()
+
+	flagged = []
+	for knob, values in parse_series(args.knobs):
+		flagged += bench(knob, values, args.n, args.max_slope)
+
+	if flagged:
+		print("super-linear: %s" % ", ".join(flagged))
+		sys.exit(1)
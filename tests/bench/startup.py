@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Startup benchmark.
+
+Measures the cold-start cost of bin/macro-of-inline (a fresh interpreter per run)
+and the per-call cost of parsing with a fresh CParser (before) and with
+the pooled parser of ext_pycparser (after).
+
+With --baseline, the cold start of another tree (a checkout directory or
+a git revision of this repository) is measured too, on the same input.
+
+usage: python tests/bench/startup.py [-n N] [--baseline DIR|REV] [FILE [OPTION ...]]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, ROOT)
+
+from macro_of_inline import ext_pycparser
+from pycparser import c_parser
+
+DEFAULT_FILE = os.path.join(ROOT, "tests", "proj", "main.c")
+DEFAULT_OPTIONS = ["--with-cpp=gcc", "-X", "_I%s" % os.path.join(ROOT, "macro_of_inline", "fake_libc_include")]
+
+def timeit(f, n):
+	"""
+	Return (min, mean) in milliseconds
+	"""
+	xs = []
+	for i in xrange(n):
+		t = time.time()
+		f()
+		xs.append((time.time() - t) * 1000)
+	return (min(xs), sum(xs) / len(xs))
+
+def report(title, (best, mean)):
+	print("%-32s min %9.3f[ms]  mean %9.3f[ms]" % (title, best, mean))
+
+def cold_start(root, filename, options, n):
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join([root, env.get("PYTHONPATH", "")])
+	cmd = [sys.executable, os.path.join(root, "bin", "macro-of-inline"), filename, "-o", os.devnull] + options
+	def run():
+		subprocess.check_call(cmd, env=env, cwd=os.path.dirname(filename))
+	return timeit(run, n)
+
+def per_call(txt, n):
+	def fresh():
+		c_parser.CParser().parse(txt)
+	def pooled():
+		ext_pycparser.ast_of(txt)
+	return (timeit(fresh, n), timeit(pooled, n))
+
+def checkout(rev):
+	"""
+	Git revision -> temporary directory of its tree
+	"""
+	with open(os.devnull, "w") as null:
+		if subprocess.call(["git", "rev-parse", "--verify", "-q", rev + "^{commit}"], cwd=ROOT, stdout=null):
+			sys.exit("%s is neither a directory nor a git revision" % rev)
+	dirname = tempfile.mkdtemp(prefix="macro-of-inline-")
+	archive = subprocess.Popen(["git", "archive", rev], cwd=ROOT, stdout=subprocess.PIPE)
+	subprocess.check_call(["tar", "-x", "-C", dirname], stdin=archive.stdout)
+	archive.stdout.close()
+	archive.wait()
+	return dirname
+
+SMALL = r"""
+typedef int T;
+static inline void f(T *x) { *x += 1; }
+int main(void) { T x = 0; f(&x); return x; }
+"""
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="startup benchmark of macro-of-inline")
+	parser.add_argument("-n", type=int, default=10, help="iterations (default:10)")
+	parser.add_argument("--baseline", metavar="DIR|REV", help="checkout directory or git revision to compare the cold start with")
+	parser.add_argument("file", metavar="FILE", nargs="?", default=DEFAULT_FILE)
+	parser.add_argument("options", metavar="OPTION", nargs=argparse.REMAINDER)
+	args = parser.parse_args()
+
+	filename = os.path.abspath(args.file)
+	options = args.options if args.file != DEFAULT_FILE or args.options else DEFAULT_OPTIONS
+
+	if args.baseline:
+		if os.path.isdir(args.baseline):
+			report("cold start (before)", cold_start(os.path.abspath(args.baseline), filename, options, args.n))
+		else:
+			root = checkout(args.baseline)
+			try:
+				report("cold start (before: %s)" % args.baseline, cold_start(root, filename, options, args.n))
+			finally:
+				shutil.rmtree(root)
+		report("cold start (after)", cold_start(ROOT, filename, options, args.n))
+	else:
+		report("cold start (bin/macro-of-inline)", cold_start(ROOT, filename, options, args.n))
+
+	fresh, pooled = per_call(SMALL, args.n * 10)
+	report("ast_of (fresh CParser)", fresh)
+	report("ast_of (pooled CParser)", pooled)
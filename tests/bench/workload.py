@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Synthetic C workload.
+
+Generates a translation unit (workload.c) and the header it includes
+(workload.h) from a few knobs:
+
+  functions  number of the static inline functions
+  fanout     calls from a function to the functions of the next layer
+  depth      layers of the call graph (the nesting of the expanded macros)
+  body       statements in a function body other than the calls
+  non_void   ratio of the functions returning a value
+  typedefs   typedefs in the header
+
+The output is deterministic for the same knobs.
+
+usage: python tests/bench/workload.py [-o DIR] [--functions N] [--fanout N] ...
+"""
+
+import argparse
+import os
+
+DEFAULTS = {
+	"functions": 16,
+	"fanout": 2,
+	"depth": 3,
+	"body": 8,
+	"non_void": 0.5,
+	"typedefs": 16,
+}
+
+class Workload:
+	def __init__(self, functions, fanout, depth, body, non_void, typedefs):
+		self.functions = functions
+		self.fanout = fanout
+		self.depth = max(1, min(depth, functions))
+		self.body = body
+		self.non_void = non_void
+		self.typedefs = typedefs
+
+		# Layer k calls layer k+1 only. No recursion.
+		self.layers = [[] for _ in xrange(self.depth)]
+		for i in xrange(functions):
+			self.layers[i * self.depth // functions].append(i)
+
+	def returnsValue(self, i):
+		# Spread the non-void functions evenly over the layers
+		return int((i + 1) * self.non_void) != int(i * self.non_void)
+
+	def callees(self, k, pos):
+		if k + 1 == self.depth:
+			return []
+		layer = self.layers[k + 1]
+		return [layer[(pos * self.fanout + j) % len(layer)] for j in xrange(self.fanout)]
+
+	def header(self):
+		lines = []
+		lines.append("#ifndef WORKLOAD_H")
+		lines.append("#define WORKLOAD_H")
+		for i in xrange(self.typedefs):
+			lines.append("typedef struct { int a; int b; } T%d_t;" % i)
+		lines.append("extern int g_state;")
+		lines.append("#endif")
+		return '\n'.join(lines) + '\n'
+
+	def function(self, i, callees):
+		lines = []
+		if self.returnsValue(i):
+			lines.append("static inline int f%d(int x)" % i)
+			lines.append("{")
+			lines.append("\tint y = x;")
+		else:
+			lines.append("static inline void f%d(int *p)" % i)
+			lines.append("{")
+			lines.append("\tint y = *p;")
+		if self.typedefs:
+			lines.append("\tT%d_t t;" % (i % self.typedefs))
+			lines.append("\tt.a = y;")
+
+		for j in xrange(self.body):
+			if j % 2:
+				lines.append("\tif (y > %d) { y = y - %d; }" % (j * 10, j))
+			else:
+				lines.append("\ty = y * 3 + %d;" % j)
+
+		for c in callees:
+			if self.returnsValue(c):
+				lines.append("\ty += f%d(y);" % c)
+			else:
+				lines.append("\tf%d(&y);" % c)
+
+		if self.typedefs:
+			lines.append("\ty += t.a;")
+		if self.returnsValue(i):
+			lines.append("\treturn y;")
+		else:
+			lines.append("\t*p = y;")
+		lines.append("}")
+		return '\n'.join(lines)
+
+	def source(self):
+		chunks = ['#include "workload.h"', "int g_state;"]
+		# Callees are defined before the callers
+		for k in reversed(xrange(self.depth)):
+			for pos, i in enumerate(self.layers[k]):
+				chunks.append(self.function(i, self.callees(k, pos)))
+
+		lines = ["int main(void)", "{", "\tint x = g_state;"]
+		for i in self.layers[0]:
+			if self.returnsValue(i):
+				lines.append("\tx += f%d(x);" % i)
+			else:
+				lines.append("\tf%d(&x);" % i)
+		lines.append("\treturn x;")
+		lines.append("}")
+		chunks.append('\n'.join(lines))
+		return '\n\n'.join(chunks) + '\n'
+
+	def write(self, dirname):
+		"""
+		Return the path of the .c file
+		"""
+		if not os.path.exists(dirname):
+			os.makedirs(dirname)
+		with open(os.path.join(dirname, "workload.h"), "w") as fp:
+			fp.write(self.header())
+		filename = os.path.join(dirname, "workload.c")
+		with open(filename, "w") as fp:
+			fp.write(self.source())
+		return filename
+
+def add_arguments(parser):
+	for knob, default in sorted(DEFAULTS.items()):
+		parser.add_argument("--%s" % knob.replace("_", "-"), dest=knob, metavar="N",
+			type=type(default), default=default, help="(default:%s)" % default)
+
+def of_args(args):
+	return Workload(**dict([(knob, getattr(args, knob)) for knob in DEFAULTS]))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="synthetic C workload for macro-of-inline")
+	parser.add_argument("-o", metavar="DIR", default=".", help="output directory (default:.)")
+	add_arguments(parser)
+	args = parser.parse_args()
+	print(of_args(args).write(args.o))